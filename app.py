@@ -2,87 +2,145 @@
 # Multi-tab dashboard combining Technical, Fundamental, and PE Analysis
 
 import asyncio
+import hashlib
 import json
+import logging
 import os
+import queue
 import re
+import threading
+import time
 import traceback
-from typing import Any, Dict, List, Optional
-
+from collections import Counter
+from concurrent.futures import Executor, ThreadPoolExecutor, wait as wait_futures
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
 import pandas as pd
 import streamlit as st
-import plotly.graph_objects as go
-import plotly.express as px
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Local imports
-from src.data.price_api import PriceAPI
-from src.data.fundamental_api import FundamentalAPI
-from src.data.pe_api import PEAPI
+# plotly, các data API (vnstock/talib) và agent (google-generativeai) được import trong
+# hàm dùng đến chúng để trang đầu tiên hiện ra nhanh hơn khi Streamlit khởi động.
+from src.utils.config import load_config
 
-from src.agents.technical_analyst import MarketContext as TechnicalMarketContext, TechnicalAnalyst
-from src.agents.fundamental_analyst import MarketContext as FundamentalMarketContext, FundamentalAnalyst, AnalysisResponse
-from src.agents.pe_valuation_analyst import MarketContext as PEMarketContext, PEValuationAnalyst
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = Path("config.json")
 
 # ==============================================================================
 # UTILITY FUNCTIONS
 # ==============================================================================
 
-@st.cache_data(ttl=300)
+async def fetch_price_data(symbol: str):
+    """Gọi đồng thời 3 endpoint của PriceAPI (mỗi lời gọi vnstock là blocking nên chạy trong thread)."""
+    from src.data.price_api import PriceAPI
+
+    api = await asyncio.to_thread(PriceAPI, symbol, 'VCI')
+    return await asyncio.gather(
+        asyncio.to_thread(api.get_enhanced_price_history),
+        asyncio.to_thread(api.get_comprehensive_analysis),
+        asyncio.to_thread(api.get_index_history),
+    )
+
+# Cache dữ liệu giá ở tầng async (dùng chung cho coroutine trên loop và wrapper blocking):
+# chỉ lưu kết quả thành công; DataFrame được dùng chung giữa các phiên nên coi là read-only
+PRICE_DATA_TTL = 300
+_price_data_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+_price_data_lock = threading.Lock()
+
+async def load_data_from_api_async(symbol: str) -> Dict[str, Any]:
+    """
+    Tải tất cả dữ liệu kỹ thuật cần thiết từ PriceAPI (await trực tiếp trên event loop).
+    Lỗi được raise lại cho caller; kết quả lỗi không được cache.
+    """
+    with _price_data_lock:
+        entry = _price_data_cache.get(symbol)
+    if entry is not None and time.monotonic() - entry[0] < PRICE_DATA_TTL:
+        return entry[1]
+    price_df, comprehensive_analysis, index_history = await fetch_price_data(symbol)
+    data = {
+        "price_df": price_df,
+        "comprehensive_analysis": comprehensive_analysis,
+        "index_history": index_history
+    }
+    with _price_data_lock:
+        _price_data_cache[symbol] = (time.monotonic(), data)
+    return data
+
 def load_data_from_api(symbol: str) -> Dict[str, Any]:
     """
-    Tải tất cả dữ liệu kỹ thuật cần thiết từ PriceAPI.
+    Wrapper blocking của load_data_from_api_async, chỉ dùng từ script thread.
+    Không gọi từ code chạy trên executor của loop dùng chung (run_async sẽ chờ chính loop đó).
     """
     try:
-        api = PriceAPI(symbol=symbol, source='VCI')
-        price_df = api.get_enhanced_price_history()
-        comprehensive_analysis = api.get_comprehensive_analysis()
-        index_history = api.get_index_history()
-        return {
-            "price_df": price_df,
-            "comprehensive_analysis": comprehensive_analysis,
-            "index_history": index_history
-        }
+        return run_async(load_data_from_api_async(symbol))
     except Exception as e:
         st.error(f"Lỗi tải dữ liệu kỹ thuật cho mã {symbol}: {str(e)}")
         traceback.print_exc()
         return {}
 
-@st.cache_data(ttl=300)
-def load_fundamental_data(symbol: str) -> Dict[str, Any]:
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_fundamental_data(symbol: str) -> Dict[str, Any]:
     """
-    Tải tất cả dữ liệu cơ bản cần thiết từ FundamentalAPI.
+    Tải tất cả dữ liệu cơ bản cần thiết từ FundamentalAPI (không gọi st.*).
+    Giữ nguyên DataFrame; chỉ serialize khi dựng prompt cho AI.
+    Lỗi được raise nên st.cache_data không cache kết quả lỗi.
     """
+    from src.data.fundamental_api import FundamentalAPI
+
+    api = FundamentalAPI(symbol=symbol)
+    return {
+        'income_statement': api.get_income_statement(),
+        'balance_sheet': api.get_balance_sheet(),
+        'ratios': api.get_ratio(),
+    }
+
+def load_fundamental_data(symbol: str) -> Dict[str, Any]:
     try:
-        api = FundamentalAPI(symbol=symbol)
-        return {
-            'income_statement': api.get_income_statement().to_dict(orient='records'),
-            'balance_sheet': api.get_balance_sheet().to_dict(orient='records'),
-            'ratios': api.get_ratio().to_dict(orient='records'),
-        }
+        return fetch_fundamental_data(symbol)
     except Exception as e:
         st.error(f"Lỗi tải dữ liệu cơ bản cho mã {symbol}: {str(e)}")
         return {}
 
-def ensure_event_loop() -> asyncio.AbstractEventLoop:
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            import nest_asyncio
-            nest_asyncio.apply()
-        return loop
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop
+@st.cache_resource
+def get_shared_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop dùng chung cho mọi phiên, chạy trên một daemon thread riêng.
+    Streamlit chạy lại script mỗi lần tương tác nên loop được giữ qua st.cache_resource.
+    """
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="shared-event-loop", daemon=True).start()
+    return loop
 
 def run_async(coro) -> Any:
-    loop = ensure_event_loop()
-    return loop.run_until_complete(coro)
+    return asyncio.run_coroutine_threadsafe(coro, get_shared_loop()).result()
+
+@lru_cache(maxsize=None)
+def _number_format_spec(decimals: int) -> str:
+    return f",.{decimals}f"
 
 def fmt_number(value: Any, decimals: int = 0, default: str = 'N/A') -> str:
-    if value is None or pd.isna(value):
+    # Nhánh nhanh cho None / float thường; mọi kiểu còn lại (np.float32 NaN, pd.NA, pd.NaT) qua pd.isna
+    if value is None:
+        return default
+    if isinstance(value, float):
+        if value != value:
+            return default
+    elif pd.isna(value) is True:
         return default
     try:
-        return f"{float(value):,.{decimals}f}"
+        return format(float(value), _number_format_spec(decimals))
     except (ValueError, TypeError):
         return str(value)
 
@@ -90,6 +148,8 @@ def fmt_number(value: Any, decimals: int = 0, default: str = 'N/A') -> str:
 # PARSE AI RESPONSE FUNCTION
 # ==============================================================================
 
+_JSON_BLOCK_RE = re.compile(r'```(?:json)?\s*\n(.*?)\n```', re.DOTALL)
+
 def extract_and_parse_ai_json(ai_response) -> Dict[str, Any]:
     if not ai_response or not hasattr(ai_response, 'content'):
         return {}
@@ -108,21 +168,27 @@ def extract_and_parse_ai_json(ai_response) -> Dict[str, Any]:
     
     return {}
 
+@lru_cache(maxsize=32)
+def _loads_json_block(text: str) -> Dict[str, Any]:
+    """
+    Regex + orjson cho một phản hồi AI. Được lru_cache theo chính chuỗi text nên các lần
+    rerun render lại cùng phản hồi không phải parse lại; lỗi parse không bị cache.
+    """
+    # JSON within triple backticks, possibly with 'json' label
+    match = _JSON_BLOCK_RE.search(text)
+
+    if match:
+        return orjson.loads(match.group(1))
+
+    # Fallback for text that is just the JSON string without backticks
+    cleaned_text = text.strip().removeprefix('```json').removeprefix('```').removesuffix('```').strip()
+    return orjson.loads(cleaned_text)
+
 def parse_json_from_markdown(text: str) -> Dict[str, Any]:
     try:
-        # Improved pattern to find JSON within triple backticks, possibly with 'json' label
-        json_pattern = r'```(?:json)?\s*\n(.*?)\n```'
-        match = re.search(json_pattern, text, re.DOTALL)
-        
-        if match:
-            json_str = match.group(1)
-            return json.loads(json_str)
-        
-        # Fallback for text that is just the JSON string without backticks
-        cleaned_text = text.replace('```json', '').replace('```', '').strip()
-        return json.loads(cleaned_text)
-        
-    except (json.JSONDecodeError, AttributeError) as e:
+        return _loads_json_block(text)
+
+    except (json.JSONDecodeError, AttributeError, TypeError) as e:
         st.error(f"Lỗi parse JSON: {e}")
         st.write("Raw text:", text[:500] + "..." if len(text) > 500 else text)
         return {}
@@ -131,61 +197,87 @@ def parse_json_from_markdown(text: str) -> Dict[str, Any]:
 # DASHBOARD DISPLAY FUNCTIONS (TECHNICAL)
 # ==============================================================================
 
-def show_colored_action(action: str):
-    color_map = {'BUY': '#28a745', 'HOLD': '#ffc107', 'SELL': '#dc3545', 'STRONG_BUY': '#155724', 'STRONG_SELL': '#721c24'}
-    color = color_map.get(action, '#6c757d')
-    st.markdown(
-        f"<div style='text-align: center; padding: 10px; background-color: {color}; "
-        f"color: white; border-radius: 8px; font-size: 18px; font-weight: bold;'>{action}</div>",
-        unsafe_allow_html=True
-    )
+# Màu cho từng khuyến nghị (dùng chung cho tab kỹ thuật và cơ bản)
+_ACTION_COLORS: Dict[str, str] = {
+    'BUY': '#28a745', 'HOLD': '#ffc107', 'SELL': '#dc3545',
+    'STRONG_BUY': '#155724', 'STRONG_SELL': '#721c24'
+}
+_DEFAULT_ACTION_COLOR = '#6c757d'  # Xám mặc định
 
-def show_confidence_gauge(confidence: float):
-    fig = go.Figure(go.Indicator(
-        mode = "gauge+number+delta", value = confidence, domain = {'x': [0, 1], 'y': [0, 1]},
-        title = {'text': "Độ tin cậy (%)"}, delta = {'reference': 50},
-        gauge = {'axis': {'range': [None, 100]}, 'bar': {'color': "darkblue"},
-                 'steps': [{'range': [0, 50], 'color': "lightgray"}, {'range': [50, 85], 'color': "gray"}, {'range': [85, 100], 'color': "lightgreen"}],
-                 'threshold': {'line': {'color': "red", 'width': 4}, 'thickness': 0.75, 'value': 90}}))
-    fig.update_layout(height=300, margin=dict(l=20, r=20, t=40, b=20))
-    st.plotly_chart(fig, use_container_width=True)
+_ACTION_BADGE_HTML = (
+    "<div style='text-align: center; padding: 10px; background-color: {color}; "
+    "color: white; border-radius: 8px; font-size: 18px; font-weight: bold;'>{action}</div>"
+)
+_ACTION_SPAN_HTML = "<span style='font-size: 1.2em; color:{color}; font-weight:bold'>{action}</span>"
+
+def show_colored_action(action: str):
+    color = _ACTION_COLORS.get(action, _DEFAULT_ACTION_COLOR)
+    st.markdown(_ACTION_BADGE_HTML.format(color=color, action=action), unsafe_allow_html=True)
 
 def show_investment_scores(scores: dict):
     if not scores:
         st.warning("Không có dữ liệu điểm đầu tư")
         return
     
+    import plotly.graph_objects as go
+
     labels = list(scores.keys())
-    values = [int(s) if isinstance(s, (int, float)) else 0 for s in scores.values()]
-    average_score = sum(values) / len(values) if values else 0
+    values = np.fromiter((v if isinstance(v, (int, float)) else 0.0 for v in scores.values()), dtype=np.float64, count=len(scores))
+    average_score = float(values.mean())
     st.metric(label="Điểm trung bình", value=f"{average_score:.1f}/100")
+    # Khép kín đa giác radar: lặp lại điểm đầu ở cuối
+    r = np.empty(len(values) + 1)
+    r[:-1] = values
+    r[-1] = values[0]
     fig = go.Figure()
-    fig.add_trace(go.Scatterpolar(r=values + [values[0]], theta=labels + [labels[0]], fill='toself', name='Điểm số'))
+    fig.add_trace(go.Scatterpolar(r=r, theta=labels + [labels[0]], fill='toself', name='Điểm số'))
     fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 100])), height=450, showlegend=False)
     st.plotly_chart(fig, use_container_width=True)
     
+@st.cache_data(ttl=300, show_spinner=False)
+def build_price_chart(frame_hash: int, _price_df: pd.DataFrame) -> dict:
+    """Dựng biểu đồ giá/khối lượng; cache theo hash nội dung frame nên rerun không dựng lại figure."""
+    import plotly.graph_objects as go
+
+    t = _price_df['time'].to_numpy()
+    fig = go.Figure()
+    fig.add_trace(go.Candlestick(x=t, open=_price_df['open'].to_numpy(), high=_price_df['high'].to_numpy(), low=_price_df['low'].to_numpy(), close=_price_df['close'].to_numpy(), name='Price'))
+    fig.add_trace(go.Bar(x=t, y=_price_df['volume'].to_numpy(), name='Volume', yaxis='y2', opacity=0.3, marker=dict(line=dict(width=0))))
+    fig.update_layout(title="Biểu đồ giá và khối lượng", yaxis=dict(title="Giá", side="left"), yaxis2=dict(title="Khối lượng", side="right", overlaying="y"), height=450, margin=dict(l=20, r=20, t=40, b=20), uirevision='price')
+    # Trả dict thay vì JSON: st.plotly_chart nhận dict trực tiếp, không dựng + validate lại go.Figure mỗi rerun
+    return fig.to_plotly_json()
+
 def show_price_chart(price_df: pd.DataFrame):
     price_df = price_df.tail(100)
-    fig = go.Figure()
-    fig.add_trace(go.Candlestick(x=price_df['time'], open=price_df['open'], high=price_df['high'], low=price_df['low'], close=price_df['close'], name='Price'))
-    fig.add_trace(go.Bar(x=price_df['time'], y=price_df['volume'], name='Volume', yaxis='y2', opacity=0.3))
-    fig.update_layout(title="Biểu đồ giá và khối lượng", yaxis=dict(title="Giá", side="left"), yaxis2=dict(title="Khối lượng", side="right", overlaying="y"), height=450, margin=dict(l=20, r=20, t=40, b=20))
-    st.plotly_chart(fig, use_container_width=True)
+    # Hash toàn bộ giá trị 100 dòng (không chỉ phiên cuối): hai mã cùng ngày + cùng giá đóng cửa không đụng khóa
+    frame_hash = int(pd.util.hash_pandas_object(price_df, index=False).sum())
+    st.plotly_chart(build_price_chart(frame_hash, price_df), use_container_width=True)
 
 def show_scenarios_table(scenarios: dict):
     if not scenarios:
         st.warning("Không có scenarios")
         return
     
-    scenario_data = []
+    # Dựng theo cột (một list cho mỗi cột) thay vì list các dict theo dòng
+    columns = {"Scenario": [], "Target Price": [], "Probability": [], "Key Drivers": [], "Description": []}
     for scenario_name, scenario_info in scenarios.items():
         if isinstance(scenario_info, dict):
-            scenario_data.append({"Scenario": scenario_name.title(), "Target Price": scenario_info.get('target_price', 'N/A'), "Probability": scenario_info.get('probability', 'N/A'), "Key Drivers": ', '.join(scenario_info.get('drivers', [])) if scenario_info.get('drivers') else 'N/A'})
+            drivers = scenario_info.get('drivers')
+            columns["Scenario"].append(scenario_name.title())
+            columns["Target Price"].append(scenario_info.get('target_price', 'N/A'))
+            columns["Probability"].append(scenario_info.get('probability', 'N/A'))
+            columns["Key Drivers"].append(', '.join(drivers) if drivers else 'N/A')
+            columns["Description"].append(None)
         else:
-            scenario_data.append({"Scenario": scenario_name, "Description": str(scenario_info)})
-    
-    if scenario_data:
-        df_scenarios = pd.DataFrame(scenario_data)
+            columns["Scenario"].append(scenario_name)
+            columns["Target Price"].append(None)
+            columns["Probability"].append(None)
+            columns["Key Drivers"].append(None)
+            columns["Description"].append(str(scenario_info))
+
+    if columns["Scenario"]:
+        # Bỏ các cột không có giá trị nào (vd. Description khi mọi scenario đều là dict)
+        df_scenarios = pd.DataFrame({k: v for k, v in columns.items() if any(x is not None for x in v)})
         st.table(df_scenarios)
     else:
         st.warning("Không có scenarios hợp lệ")
@@ -193,6 +285,16 @@ def show_scenarios_table(scenarios: dict):
 # ==============================================================================
 # DISPLAY FUNCTION (FUNDAMENTAL)
 # ==============================================================================
+_SCENARIO_KEYS = ('bull', 'neutral', 'bear')
+
+# Định dạng hiển thị bảng DuPont: cột -> (format %, hệ số nhân)
+_DUPONT_TABLE_FORMATS = {
+    'Biên lợi nhuận (%)': ('%.2f%%', 100.0),
+    'Vòng quay tài sản': ('%.2f', 1.0),
+    'Đòn bẩy TC': ('%.2f', 1.0),
+    'ROE (%)': ('%.2f%%', 100.0),
+}
+
 def show_unified_analysis(analysis_data: Dict[str, Any], dupont_components: List[Dict[str, Any]]):
     """Hiển thị toàn bộ phân tích cơ bản trong một tab duy nhất, chuyên nghiệp."""
     st.header("Phân tích cơ bản chuyên sâu theo phương pháp DuPont")
@@ -205,31 +307,30 @@ def show_unified_analysis(analysis_data: Dict[str, Any], dupont_components: List
     strat = analysis_data.get('strategy_recommendation', {})
     action = strat.get('action', 'N/A')
     st.markdown("**Khuyến nghị hành động:** ")
-    color_map = {
-        'BUY': '#28a745', 'HOLD': '#ffc107', 'SELL': '#dc3545',
-        'STRONG_BUY': '#155724', 'STRONG_SELL': '#721c24'
-    }
-    color = color_map.get(action, '#6c757d')  # Xám mặc định
-    st.markdown(f"<span style='font-size: 1.2em; color:{color}; font-weight:bold'>{action}</span>", unsafe_allow_html=True)
-
-    st.markdown(f"**Lý do:** {strat.get('reasoning', 'N/A')}")
-    st.markdown(f"**Thời gian đầu tư:** {strat.get('time_horizon', 'N/A')}")
+    color = _ACTION_COLORS.get(action, _DEFAULT_ACTION_COLOR)
+    st.markdown(_ACTION_SPAN_HTML.format(color=color, action=action), unsafe_allow_html=True)
 
+    # Gộp mỗi khối văn bản thành một lần st.markdown (mỗi lời gọi là một delta gửi qua websocket)
     scores = analysis_data.get('investment_scores', {})
-    st.markdown("**Điểm số đầu tư:**")
-    st.markdown(f"- Chất lượng ROE: {fmt_number(scores.get('roe_quality'))}/100")
-    st.markdown(f"- Mức rủi ro: {fmt_number(scores.get('risk_level'))}/100")
-    st.markdown(f"- Tổng điểm: {fmt_number(scores.get('summary_score'))}/100")
+    st.markdown(
+        f"**Lý do:** {strat.get('reasoning', 'N/A')}\n\n"
+        f"**Thời gian đầu tư:** {strat.get('time_horizon', 'N/A')}\n\n"
+        "**Điểm số đầu tư:**\n"
+        f"- Chất lượng ROE: {fmt_number(scores.get('roe_quality'))}/100\n"
+        f"- Mức rủi ro: {fmt_number(scores.get('risk_level'))}/100\n"
+        f"- Tổng điểm: {fmt_number(scores.get('summary_score'))}/100"
+    )
 
     # Phân tích DuPont chi tiết
     st.subheader("Phân tích DuPont chi tiết")
     dupont = analysis_data.get('dupont_analysis', {})
-    st.markdown(f"**Xu hướng lợi nhuận biên:** {dupont.get('profit_margin_trend', 'N/A')}")
-    st.markdown(f"**Xu hướng hiệu quả sử dụng tài sản:** {dupont.get('asset_turnover_trend', 'N/A')}")
-    st.markdown(f"**Xu hướng đòn bẩy tài chính:** {dupont.get('equity_multiplier_trend', 'N/A')}")
-    st.markdown(f"**Tổng thể ROE:** {dupont.get('roe_overall', 'N/A')}")
-
-    st.markdown(f"**Nhận định chuyên môn:** {analysis_data.get('professional_insight', 'N/A')}")
+    st.markdown(
+        f"**Xu hướng lợi nhuận biên:** {dupont.get('profit_margin_trend', 'N/A')}\n\n"
+        f"**Xu hướng hiệu quả sử dụng tài sản:** {dupont.get('asset_turnover_trend', 'N/A')}\n\n"
+        f"**Xu hướng đòn bẩy tài chính:** {dupont.get('equity_multiplier_trend', 'N/A')}\n\n"
+        f"**Tổng thể ROE:** {dupont.get('roe_overall', 'N/A')}\n\n"
+        f"**Nhận định chuyên môn:** {analysis_data.get('professional_insight', 'N/A')}"
+    )
 
     # Bảng dữ liệu DuPont
     if dupont_components:
@@ -239,18 +340,21 @@ def show_unified_analysis(analysis_data: Dict[str, Any], dupont_components: List
         rename_map = {'year': 'Năm', 'profit_margin': 'Biên lợi nhuận (%)', 'asset_turnover': 'Vòng quay tài sản', 'equity_multiplier': 'Đòn bẩy TC', 'roe': 'ROE (%)'}
         df_display = df.rename(columns=rename_map)
         
-        # Format columns for display
-        st.dataframe(df_display.style.format({
-            'Biên lợi nhuận (%)': '{:.2%}',
-            'Vòng quay tài sản': '{:.2f}',
-            'Đòn bẩy TC': '{:.2f}',
-            'ROE (%)': '{:.2%}'
-        }), use_container_width=True)
+        # Format columns for display: chuyển sẵn thành chuỗi theo cột (không dùng Styler,
+        # vốn gọi formatter Python và bọc HTML cho từng ô). df_display giữ số để vẽ biểu đồ.
+        df_table = df_display.copy()
+        for col, (fmt, scale) in _DUPONT_TABLE_FORMATS.items():
+            if col in df_table.columns:
+                values = pd.to_numeric(df_table[col], errors='coerce').to_numpy(dtype=np.float64) * scale
+                df_table[col] = np.where(np.isnan(values), 'N/A', np.char.mod(fmt, values))
+        st.dataframe(df_table, use_container_width=True)
 
 
         # Biểu đồ xu hướng ROE
         st.subheader("Biểu đồ xu hướng ROE")
         if 'Năm' in df_display.columns and 'ROE (%)' in df_display.columns:
+            import plotly.express as px
+
             fig = px.line(df_display, x='Năm', y='ROE (%)', title='Xu hướng ROE theo thời gian', markers=True)
             fig.update_layout(yaxis_title='ROE (%)', xaxis_title='Năm')
             st.plotly_chart(fig, use_container_width=True)
@@ -261,33 +365,32 @@ def show_unified_analysis(analysis_data: Dict[str, Any], dupont_components: List
     # Các kịch bản đầu tư
     st.subheader("Các kịch bản đầu tư")
     scenarios = analysis_data.get('scenarios', {})
-    for scen in ['bull', 'neutral', 'bear']:
-        sc = scenarios.get(scen, {})
-        st.markdown(f"#### Kịch bản {scen.capitalize()}")
-        st.markdown(f"- **Giá mục tiêu:** {fmt_number(sc.get('target_price'), 0)}")
-        st.markdown(f"- **Xác suất:** {fmt_number(sc.get('probability', 0) * 100, 2)}%")
-        st.markdown("- **Yếu tố thúc đẩy:**")
-        for d in sc.get('drivers', []):
-            st.markdown(f"  - {d}")
+    # Một bảng cho cả 3 kịch bản thay vì một khối markdown cho từng kịch bản
+    scen_list = [scenarios.get(scen, {}) for scen in _SCENARIO_KEYS]
+    st.dataframe(pd.DataFrame({
+        'Kịch bản': [scen.capitalize() for scen in _SCENARIO_KEYS],
+        'Giá mục tiêu': [fmt_number(sc.get('target_price'), 0) for sc in scen_list],
+        'Xác suất (%)': [fmt_number((sc.get('probability') or 0) * 100, 2) for sc in scen_list],
+        'Yếu tố thúc đẩy': [' • '.join(sc.get('drivers', [])) for sc in scen_list],
+    }), use_container_width=True, hide_index=True)
 
     # Điểm nhấn và rủi ro
     st.subheader("Điểm nhấn và Rủi ro")
     col1, col2 = st.columns(2)
     with col1:
-        st.markdown("**Điểm nhấn chính:**")
-        for point in analysis_data.get('key_highlights', []):
-            st.markdown(f"- {point}")
+        highlights = "".join(f"\n- {point}" for point in analysis_data.get('key_highlights', []))
+        st.markdown(f"**Điểm nhấn chính:**\n{highlights}")
     with col2:
-        st.markdown("**Yếu tố rủi ro:**")
-        for risk in analysis_data.get('risk_factors', []):
-            st.markdown(f"- {risk}")
+        risks = "".join(f"\n- {risk}" for risk in analysis_data.get('risk_factors', []))
+        st.markdown(f"**Yếu tố rủi ro:**\n{risks}")
 
 # ==============================================================================
 # DISPLAY FUNCTION (PE VALUATION HELPERS)
 # ==============================================================================
 def current_close(pe_df: pd.DataFrame) -> float | None:
     try:
-        return float(pe_df.iloc[0]["close"])
+        # Lấy cột trước rồi .iat: đường truy cập scalar, không tạo Series cho cả dòng như iloc[0]
+        return float(pe_df["close"].iat[0])
     except (IndexError, TypeError, KeyError):
         return None
 
@@ -392,6 +495,230 @@ def render_ai_dashboard(ai_json: dict, price_df: pd.DataFrame = None):
     scenarios = ai_json.get('scenarios', {})
     show_scenarios_table(scenarios)
 
+# ==============================================================================
+# ANALYSIS PIPELINES (ASYNC)
+# ==============================================================================
+
+# Executor riêng cho các wrapper blocking st.cache_data (cached_*_analysis): chúng chờ
+# run_async(...) trên loop dùng chung, nên không được chiếm worker của default executor
+# mà chính các coroutine bên trong (asyncio.to_thread) cần -> tránh cạn pool / deadlock.
+# Các coroutine bên trong không bao giờ submit vào executor này.
+_ANALYSIS_EXECUTOR = ThreadPoolExecutor(max_workers=12, thread_name_prefix="cached-analysis")
+
+async def to_thread_with_ctx(func, *args, executor: Optional[Executor] = None) -> Any:
+    """
+    Chạy hàm blocking trong thread riêng, giữ ScriptRunContext để st.* vẫn hiển thị.
+    executor=None: default executor của loop (chỉ cho hàm không chờ ngược lại loop dùng chung).
+    """
+    ctx = get_script_run_ctx()
+
+    def _call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(executor, _call)
+
+def load_pe_data(symbol: str):
+    from src.data.pe_api import DataProcessor, PEAPI
+    from src.utils.cache import price_cache
+
+    # Cùng khóa cache với PEValuationAnalyst._build_prompt: agent chạy sau dùng lại
+    # đúng các frame này thay vì tải lại giá + ratio từ VNStock
+    pe_df = price_cache.get_or_compute(symbol, "pe_trailing", lambda: PEAPI(symbol).compute_pe_trailing())
+    stats = price_cache.get_or_compute(
+        symbol, "pe_distribution_stats", lambda: DataProcessor.calculate_pe_distribution_stats(pe_df)
+    )
+    return pe_df, stats
+
+async def run_technical(symbol: str, api_key: str, on_chunk: Optional[Callable[[str], None]] = None):
+    try:
+        core_data = await load_data_from_api_async(symbol)
+    except Exception:
+        logger.exception("Lỗi tải dữ liệu kỹ thuật cho mã %s", symbol)
+        core_data = {}
+    if not core_data or core_data.get("price_df", pd.DataFrame()).empty:
+        return core_data, None
+    price_df = core_data["price_df"]
+    latest_price = price_df['close'].iloc[-1]
+    from src.agents.technical_analyst import MarketContext as TechnicalMarketContext, TechnicalAnalyst
+
+    tech_context = TechnicalMarketContext(
+        symbol=symbol, current_price=latest_price, market_data=core_data
+    )
+    technical_analyst = TechnicalAnalyst(apikey=api_key)
+    return core_data, await technical_analyst.analyze(tech_context, on_chunk=on_chunk)
+
+async def run_fundamental(symbol: str, api_key: str, on_chunk: Optional[Callable[[str], None]] = None):
+    fundamental_data = await to_thread_with_ctx(load_fundamental_data, symbol)
+    if not fundamental_data:
+        return None
+    from src.agents.fundamental_analyst import MarketContext as FundamentalMarketContext, FundamentalAnalyst
+
+    fundamental_context = FundamentalMarketContext(symbol=symbol, market_data=fundamental_data)
+    fundamental_analyst = FundamentalAnalyst(api_key=api_key)
+    return await fundamental_analyst.analyze(fundamental_context, on_chunk=on_chunk)
+
+async def run_pe(symbol: str, api_key: str, on_chunk: Optional[Callable[[str], None]] = None):
+    pe_df, stats = await to_thread_with_ctx(load_pe_data, symbol)
+    from src.agents.pe_valuation_analyst import MarketContext as PEMarketContext, PEValuationAnalyst
+
+    ctx = PEMarketContext(symbol=symbol)
+    agent = PEValuationAnalyst(api_key=api_key)
+    return pe_df, stats, await agent.analyze(ctx, on_chunk=on_chunk)
+
+# ==============================================================================
+# CACHED AI ANALYSES
+# ==============================================================================
+# Kết quả AI được cache theo (symbol, hash của API key, ngày) nên bấm lại trong
+# thời gian TTL không gọi lại Gemini. Tham số `_api_key` có dấu "_" nên Streamlit
+# không đưa key gốc vào khóa cache; `_on_chunk` (callback stream) cũng vậy.
+
+_cache_state = threading.local()
+
+def hash_api_key(api_key: str) -> str:
+    return hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest()
+
+class UncachedResult(Exception):
+    """Raise từ hàm st.cache_data để trả kết quả cho caller mà không cache (exception không được cache)."""
+    def __init__(self, value: Any):
+        super().__init__("uncached result")
+        self.value = value
+
+def _mark_cache_miss(name: str, symbol: str) -> None:
+    _cache_state.missed = True
+    logger.info("AI cache miss: %s %s", name, symbol)
+
+@st.cache_data(ttl=900, show_spinner=False)
+def cached_technical_analysis(symbol: str, api_key_hash: str, date_bucket: str, _api_key: str,
+                              _on_chunk: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    _mark_cache_miss("technical", symbol)
+    _, response = run_async(run_technical(symbol, _api_key, _on_chunk))
+    ai_content = extract_and_parse_ai_json(response)
+    if not ai_content:
+        raise ValueError(f"Không có phản hồi kỹ thuật hợp lệ cho mã {symbol}")
+    return ai_content
+
+@st.cache_data(ttl=900, show_spinner=False)
+def cached_fundamental_analysis(symbol: str, api_key_hash: str, date_bucket: str, _api_key: str,
+                                _on_chunk: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    _mark_cache_miss("fundamental", symbol)
+    ai_content = extract_and_parse_ai_json(run_async(run_fundamental(symbol, _api_key, _on_chunk)))
+    if not ai_content:
+        raise ValueError(f"Không có phản hồi cơ bản hợp lệ cho mã {symbol}")
+    return ai_content
+
+@st.cache_data(ttl=900, show_spinner=False)
+def cached_pe_analysis(symbol: str, api_key_hash: str, date_bucket: str, _api_key: str,
+                       _on_chunk: Optional[Callable[[str], None]] = None):
+    _mark_cache_miss("pe", symbol)
+    pe_df, stats, resp = run_async(run_pe(symbol, _api_key, _on_chunk))
+    if resp is None or resp.recommendation == "PARSE_ERROR":
+        # Vẫn hiển thị kết quả lỗi parse như trước, nhưng không cache nó trong TTL
+        raise UncachedResult((pe_df, stats, resp))
+    return pe_df, stats, resp
+
+def run_cached_analysis(cached_fn, name: str, symbol: str, api_key: str,
+                        on_chunk: Optional[Callable[[str, str], None]] = None) -> Any:
+    date_bucket = datetime.now(timezone.utc).strftime("%Y%m%d")
+    _cache_state.missed = False
+    chunk_cb = partial(on_chunk, name) if on_chunk else None
+    try:
+        result = cached_fn(symbol, hash_api_key(api_key), date_bucket, api_key, chunk_cb)
+    except UncachedResult as e:
+        return e.value
+    if not _cache_state.missed:
+        logger.info("AI cache hit: %s %s", name, symbol)
+    return result
+
+async def run_all_analyses(symbol: str, api_key: str, on_chunk: Optional[Callable[[str, str], None]] = None):
+    """
+    Chạy đồng thời 3 phân tích (có cache); lỗi của từng phân tích được trả về thay vì raise.
+    Wrapper cache blocking chạy trên _ANALYSIS_EXECUTOR, không trên default executor của loop.
+    on_chunk(name, text) nhận từng đoạn phản hồi AI khi cache miss (gọi từ thread của event loop).
+    """
+    return await asyncio.gather(
+        to_thread_with_ctx(run_cached_analysis, cached_technical_analysis, "technical", symbol, api_key, on_chunk,
+                           executor=_ANALYSIS_EXECUTOR),
+        to_thread_with_ctx(run_cached_analysis, cached_fundamental_analysis, "fundamental", symbol, api_key, on_chunk,
+                           executor=_ANALYSIS_EXECUTOR),
+        to_thread_with_ctx(run_cached_analysis, cached_pe_analysis, "pe", symbol, api_key, on_chunk,
+                           executor=_ANALYSIS_EXECUTOR),
+        return_exceptions=True,
+    )
+
+_STREAM_LABELS = {"technical": "📈 Technical", "fundamental": "📊 Fundamental", "pe": "🎯 PE Valuation"}
+
+def run_all_analyses_streaming(symbol: str, api_key: str, poll_interval: float = 0.2):
+    """
+    Chạy run_all_analyses trên loop dùng chung và hiển thị phản hồi AI thô trong lúc chờ.
+    Các đoạn text được đẩy qua queue.Queue từ thread của loop; script thread (chủ sở hữu
+    các placeholder) lấy ra và cập nhật UI. JSON chỉ được parse một lần khi đã đủ phản hồi.
+    """
+    chunks: "queue.Queue[tuple[str, str]]" = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        run_all_analyses(symbol, api_key, lambda name, text: chunks.put((name, text))),
+        get_shared_loop(),
+    )
+
+    stream_area = st.empty()
+    with stream_area.container():
+        cols = st.columns(len(_STREAM_LABELS))
+        placeholders = {}
+        for col, (name, label) in zip(cols, _STREAM_LABELS.items()):
+            col.caption(label)
+            placeholders[name] = col.empty()
+    buffers = {name: [] for name in _STREAM_LABELS}
+
+    while True:
+        finished = future.done()
+        updated = set()
+        while True:
+            try:
+                name, text = chunks.get_nowait()
+            except queue.Empty:
+                break
+            buffers[name].append(text)
+            updated.add(name)
+        for name in updated:
+            placeholders[name].markdown("".join(buffers[name]))
+        if finished:
+            break
+        wait_futures([future], timeout=poll_interval)
+
+    stream_area.empty()
+    return future.result()
+
+# ==============================================================================
+# BACKGROUND PREFETCH
+# ==============================================================================
+# Người dùng thường xoay vòng trong một watchlist nhỏ: sau mỗi lần render, tải trước
+# dữ liệu giá + cơ bản của các mã được xem nhiều nhất trong phiên để lần bấm sau là
+# cache hit của st.cache_data. Semaphore giới hạn số lời gọi API đồng thời cho cả process.
+
+PREFETCH_TOP_N = 5
+_PREFETCH_SLOTS = threading.Semaphore(3)
+
+def _prewarm_symbols(symbols: List[str], ctx) -> None:
+    # Gắn ScriptRunContext của phiên để st.cache_data chạy như trong script thread;
+    # chỉ gọi các hàm tải thô (không st.*), lỗi raise nên không bị cache
+    add_script_run_ctx(threading.current_thread(), ctx)
+    for sym in symbols:
+        with _PREFETCH_SLOTS:
+            try:
+                run_async(load_data_from_api_async(sym))
+                fetch_fundamental_data(sym)
+            except Exception:
+                logger.debug("Prefetch failed for %s", sym, exc_info=True)
+
+def prefetch_watchlist(current_symbol: str) -> None:
+    history: Counter = st.session_state.setdefault("symbol_history", Counter())
+    history[current_symbol] += 1
+    targets = [sym for sym, _ in history.most_common(PREFETCH_TOP_N) if sym != current_symbol]
+    if targets:
+        threading.Thread(
+            target=_prewarm_symbols, args=(targets, get_script_run_ctx()), name="symbol-prefetch", daemon=True
+        ).start()
+
 # ==============================================================================
 # MAIN APPLICATION FLOW
 # ==============================================================================
@@ -403,10 +730,8 @@ def main():
     with st.sidebar:
         st.header("⚙️ Cấu hình")
         code = st.text_input("Vui lòng nhập code từ GOLDEN KEY", value="", type="password")
-        with open("config.json", "r") as f:
-            cfg = json.load(f)
-            api_key = cfg.get(f"{code}", "")
-
+        # load_config được lru_cache: chỉ đọc + parse config.json một lần cho cả process
+        api_key = load_config(CONFIG_PATH).get(f"{code}", "")
         
         symbol = st.text_input("Mã cổ phiếu", value="HPG").upper().strip()
         run_analysis = st.button("🚀 Chạy phân tích", type="primary", use_container_width=True)
@@ -426,42 +751,30 @@ def main():
     with st.spinner(f"AI Agents đang phân tích {symbol}... Vui lòng đợi trong giây lát."):
 
         try:
+            # Chạy song song 3 phân tích (kỹ thuật, cơ bản, định giá PE)
+            technical_result, fundamental_result, pe_result = run_all_analyses_streaming(symbol, api_key)
+
             # --- 1. Phân tích kỹ thuật (Technical Analysis) ---
-            core_data = load_data_from_api(symbol)
-            technical_ai_content = {}
-            if core_data and not core_data.get("price_df", pd.DataFrame()).empty:
-                price_df = core_data["price_df"]
-                latest_price = price_df['close'].iloc[-1]
-                tech_context = TechnicalMarketContext(
-                    symbol=symbol, current_price=latest_price, market_data=core_data
-                )
-                technical_analyst = TechnicalAnalyst(apikey=api_key)
-                technical_ai_response = run_async(technical_analyst.analyze(tech_context))
-                technical_ai_content = extract_and_parse_ai_json(technical_ai_response)
+            core_data, technical_ai_content = {}, {}
+            if isinstance(technical_result, Exception):
+                st.error(f"Lỗi trong quá trình phân tích kỹ thuật: {technical_result}")
+            else:
+                technical_ai_content = technical_result
+                core_data = load_data_from_api(symbol)
 
             # --- 2. Phân tích cơ bản (Fundamental Analysis) ---
-            fundamental_data = load_fundamental_data(symbol)
             fundamental_ai_content = {}
-            if fundamental_data:
-                fundamental_context = FundamentalMarketContext(symbol=symbol, market_data=fundamental_data)
-                fundamental_analyst = FundamentalAnalyst(api_key=api_key)
-                fundamental_ai_response = run_async(fundamental_analyst.analyze(fundamental_context))
-                fundamental_ai_content = extract_and_parse_ai_json(fundamental_ai_response)
-            
+            if isinstance(fundamental_result, Exception):
+                st.error(f"Lỗi trong quá trình phân tích cơ bản: {fundamental_result}")
+            else:
+                fundamental_ai_content = fundamental_result
+
             # --- 3. Phân tích định giá PE (PE Valuation) ---
             pe_df, stats, resp = None, {}, None
-            try:
-                # Data loading for PE
-                pe_api = PEAPI(symbol)
-                pe_df = pe_api.compute_pe_trailing()
-                stats = pe_api.calculate_pe_distribution_stats(pe_df)
-                
-                # AI Analysis for PE
-                ctx = PEMarketContext(symbol=symbol)
-                agent = PEValuationAnalyst(api_key=api_key)
-                resp = run_async(agent.analyze(ctx))
-            except Exception as pe_error:
-                st.warning(f"Lỗi trong quá trình phân tích PE: {pe_error}")
+            if isinstance(pe_result, Exception):
+                st.warning(f"Lỗi trong quá trình phân tích PE: {pe_result}")
+            else:
+                pe_df, stats, resp = pe_result
 
 
             # --- Render kết quả ra các tab ---
@@ -500,26 +813,26 @@ def main():
                     st.subheader("📈 Kịch bản (AI)")
                     scenarios = resp.content.get("pe_valuation", {}).get("scenarios", {}) if resp.content else {}
                     if scenarios:
-                        rows = []
-                        for name, sc in scenarios.items():
-                            tp_val = sc.get("target_price", "N/A")
-                            tp_str = fmt_number(tp_val, 0)
-                            prob_val = sc.get("probability", "N/A")
-                            prob_str = f"{prob_val:.0%}" if isinstance(prob_val, float) else str(prob_val)
-
-                            rows.append({
-                                "Kịch bản": name.title(),
-                                "PE Target (AI)": sc.get("pe", "N/A"),
-                                "Giá mục tiêu (AI)": tp_str,
-                                "Xác suất (AI)": prob_str,
-                                "Lý do (rút gọn)": sc.get("rationale","")
-                            })
-                        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+                        sc_list = list(scenarios.values())
+                        # Xác suất dạng float (0.35) -> "35%" cho cả cột một lần; giá trị khác giữ nguyên dạng chuỗi
+                        prob_vals = [sc.get("probability", "N/A") for sc in sc_list]
+                        prob_num = np.array([v if isinstance(v, float) else np.nan for v in prob_vals], dtype=np.float64)
+                        prob_strs = np.where(np.isnan(prob_num), [str(v) for v in prob_vals], np.char.mod('%.0f%%', prob_num * 100))
+                        st.dataframe(pd.DataFrame({
+                            "Kịch bản": [name.title() for name in scenarios],
+                            "PE Target (AI)": [sc.get("pe", "N/A") for sc in sc_list],
+                            "Giá mục tiêu (AI)": [fmt_number(sc.get("target_price", "N/A"), 0) for sc in sc_list],
+                            "Xác suất (AI)": prob_strs,
+                            "Lý do (rút gọn)": [sc.get("rationale", "") for sc in sc_list],
+                        }), use_container_width=True, hide_index=True)
                     else:
                         st.warning("Không có dữ liệu kịch bản từ AI.")
                 else:
                     st.error("Không thể thực hiện hoặc hiển thị phân tích định giá PE. Dữ liệu có thể không có sẵn.")
 
+            # Sau khi render xong: làm nóng cache cho các mã hay xem trong phiên
+            prefetch_watchlist(symbol)
+
         except Exception as e:
             st.error("Đã xảy ra lỗi không mong muốn trong quá trình phân tích.")
             st.exception(e)
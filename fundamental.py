@@ -8,8 +8,11 @@ import asyncio
 import json
 import os
 import re
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
+import orjson
 import pandas as pd
 import streamlit as st
 import plotly.graph_objects as go
@@ -36,18 +39,39 @@ def get_api_key() -> Optional[str]:
     except (FileNotFoundError, json.JSONDecodeError):
         return None
 
+# nest_asyncio chỉ import một lần khi nạp module; mỗi loop chỉ patch một lần
+# (nest_asyncio đánh dấu loop đã patch bằng thuộc tính _nest_patched)
+try:
+    import nest_asyncio
+except ImportError:
+    nest_asyncio = None
+
+def _apply_nest_asyncio(loop: asyncio.AbstractEventLoop) -> None:
+    if nest_asyncio is not None and not getattr(loop, '_nest_patched', False):
+        nest_asyncio.apply(loop)
+
+# Loop riêng cho từng thread (Streamlit chạy mỗi phiên trên một script thread)
+_TLS = threading.local()
+
 # Đảm bảo event loop cho async
 def ensure_event_loop() -> asyncio.AbstractEventLoop:
+    # get_running_loop không đi qua nhánh deprecated của get_event_loop (Python 3.12+)
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            import nest_asyncio
-            nest_asyncio.apply()
-        return loop
+        loop = asyncio.get_running_loop()
     except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        loop = getattr(_TLS, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            _TLS.loop = loop
         return loop
+    _apply_nest_asyncio(loop)
+    return loop
+
+# Giữ một analyst (và Gemini client bên trong) cho mỗi api_key qua các lần rerun
+@st.cache_resource(show_spinner=False)
+def get_analyst(api_key: str, model: str = 'gemini-2.0-flash') -> FundamentalAnalyst:
+    return FundamentalAnalyst(api_key=api_key, model=model)
 
 # Chạy coroutine async
 def run_async(coro) -> Any:
@@ -66,6 +90,8 @@ def fmt_number(value: Any, decimals: int = 0, default: str = 'N/A') -> str:
 # ==============================================================================
 # PARSE AI RESPONSE FUNCTION
 # ==============================================================================
+_JSON_BLOCK_RE = re.compile(r'```(?:json)?\s*\n(.*?)\n```', re.DOTALL)
+
 def extract_and_parse_ai_json(ai_response: AnalysisResponse) -> Dict[str, Any]:
     """Extract và parse JSON từ AI response, xử lý các trường hợp khác nhau."""
     if not ai_response or not hasattr(ai_response, 'content'):
@@ -81,16 +107,19 @@ def extract_and_parse_ai_json(ai_response: AnalysisResponse) -> Dict[str, Any]:
         return parse_json_from_markdown(content)
     return {}
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def _parse_json_cached(text: str) -> Dict[str, Any]:
+    """Regex + orjson, cache theo chính chuỗi phản hồi (lỗi parse được raise nên không bị cache)."""
+    match = _JSON_BLOCK_RE.search(text)
+    if match:
+        return orjson.loads(match.group(1))
+    cleaned_text = text.strip().removeprefix('```json').removeprefix('```').removesuffix('```').strip()
+    return orjson.loads(cleaned_text)
+
 def parse_json_from_markdown(text: str) -> Dict[str, Any]:
-    """Parse JSON từ markdown text có format ``````"""
+    """Parse JSON từ markdown text có format ```json...```"""
     try:
-        json_pattern = r'``````'
-        match = re.search(json_pattern, text, re.DOTALL)
-        if match:
-            json_str = match.group(1)
-            return json.loads(json_str)
-        cleaned_text = text.replace('``````', '').strip()
-        return json.loads(cleaned_text)
+        return _parse_json_cached(text)
     except (json.JSONDecodeError, AttributeError) as e:
         st.error(f"Lỗi parse JSON: {e}")
         st.write("Raw text:", text[:500] + "..." if len(text) > 500 else text)
@@ -99,6 +128,24 @@ def parse_json_from_markdown(text: str) -> Dict[str, Any]:
 # ==============================================================================
 # UNIFIED DISPLAY FUNCTION
 # ==============================================================================
+COLOR_MAP = {
+    'BUY': '#28a745',  # Xanh lá
+    'HOLD': '#ffc107',  # Vàng
+    'SELL': '#dc3545',  # Đỏ
+    'STRONG_BUY': '#155724',  # Xanh đậm
+    'STRONG_SELL': '#721c24'  # Đỏ đậm
+}
+ACTION_LABEL_HTML = "**Khuyến nghị hành động:** <span style='color:{color}; font-weight:bold'>{action}</span>"
+
+SCENARIO_KEYS = ('bull', 'neutral', 'bear')
+
+DUPONT_COLUMN_CONFIG = {
+    'profit_margin': st.column_config.NumberColumn(format='%.2f%%'),
+    'asset_turnover': st.column_config.NumberColumn(format='%.2f'),
+    'equity_multiplier': st.column_config.NumberColumn(format='%.2f'),
+    'roe': st.column_config.NumberColumn(format='%.2f%%'),
+}
+
 def show_unified_analysis(analysis_data: Dict[str, Any], market_data: Dict[str, Any], dupont_components: List[Dict[str, Any]]):
     """Hiển thị toàn bộ phân tích trong một tab duy nhất, chuyên nghiệp."""
     st.header("Phân tích cơ bản chuyên sâu theo phương pháp DuPont")
@@ -110,75 +157,66 @@ def show_unified_analysis(analysis_data: Dict[str, Any], market_data: Dict[str,
 
     strat = analysis_data.get('strategy_recommendation', {})
     action = strat.get('action', 'N/A')
-    st.markdown("**Khuyến nghị hành động:** ")
-    color_map = {
-        'BUY': '#28a745',  # Xanh lá
-        'HOLD': '#ffc107',  # Vàng
-        'SELL': '#dc3545',  # Đỏ
-        'STRONG_BUY': '#155724',  # Xanh đậm
-        'STRONG_SELL': '#721c24'  # Đỏ đậm
-    }
-    color = color_map.get(action, '#6c757d')  # Xám mặc định
-    st.markdown(f"<span style='color:{color}; font-weight:bold'>{action}</span>", unsafe_allow_html=True)
-
-    st.markdown(f"**Lý do:** {strat.get('reasoning', 'N/A')}")
-    st.markdown(f"**Thời gian đầu tư:** {strat.get('time_horizon', 'N/A')}")
+    color = COLOR_MAP.get(action, '#6c757d')  # Xám mặc định
+    # Nhãn + span màu trong cùng một st.markdown (một delta thay vì hai)
+    st.markdown(ACTION_LABEL_HTML.format(color=color, action=action), unsafe_allow_html=True)
 
+    # Gộp mỗi khối văn bản thành một lần st.markdown (mỗi lời gọi là một delta gửi qua websocket)
     scores = analysis_data.get('investment_scores', {})
-    st.markdown("**Điểm số đầu tư:**")
-    st.markdown(f"- Chất lượng ROE: {fmt_number(scores.get('roe_quality'))}")
-    st.markdown(f"- Mức rủi ro: {fmt_number(scores.get('risk_level'))}")
-    st.markdown(f"- Tổng điểm: {fmt_number(scores.get('summary_score'))}")
+    st.markdown(
+        f"**Lý do:** {strat.get('reasoning', 'N/A')}\n\n"
+        f"**Thời gian đầu tư:** {strat.get('time_horizon', 'N/A')}\n\n"
+        "**Điểm số đầu tư:**\n"
+        f"- Chất lượng ROE: {fmt_number(scores.get('roe_quality'))}\n"
+        f"- Mức rủi ro: {fmt_number(scores.get('risk_level'))}\n"
+        f"- Tổng điểm: {fmt_number(scores.get('summary_score'))}"
+    )
 
     # Phân tích DuPont chi tiết
     st.subheader("Phân tích DuPont chi tiết")
     dupont = analysis_data.get('dupont_analysis', {})
-    st.markdown(f"**Xu hướng lợi nhuận biên:** {dupont.get('profit_margin_trend', 'N/A')}")
-    st.markdown(f"**Xu hướng hiệu quả sử dụng tài sản:** {dupont.get('asset_turnover_trend', 'N/A')}")
-    st.markdown(f"**Xu hướng đòn bẩy tài chính:** {dupont.get('equity_multiplier_trend', 'N/A')}")
-    st.markdown(f"**Tổng thể ROE:** {dupont.get('roe_overall', 'N/A')}")
-
-    st.markdown("**Nhận định chuyên môn:** {analysis_data.get('professional_insight', 'N/A')}")
+    st.markdown(
+        f"**Xu hướng lợi nhuận biên:** {dupont.get('profit_margin_trend', 'N/A')}\n\n"
+        f"**Xu hướng hiệu quả sử dụng tài sản:** {dupont.get('asset_turnover_trend', 'N/A')}\n\n"
+        f"**Xu hướng đòn bẩy tài chính:** {dupont.get('equity_multiplier_trend', 'N/A')}\n\n"
+        f"**Tổng thể ROE:** {dupont.get('roe_overall', 'N/A')}\n\n"
+        f"**Nhận định chuyên môn:** {analysis_data.get('professional_insight', 'N/A')}"
+    )
 
     # Bảng dữ liệu DuPont
     if dupont_components:
         df = pd.DataFrame(dupont_components)
         st.subheader("Dữ liệu thành phần DuPont")
-        st.dataframe(df.style.format({
-            'profit_margin': '{:.2f}%',
-            'asset_turnover': '{:.2f}',
-            'equity_multiplier': '{:.2f}',
-            'roe': '{:.2f}%'
-        }))
+        # Định dạng phía client qua column_config: DataFrame gửi đi dạng Arrow, không qua Styler
+        st.dataframe(df, column_config=DUPONT_COLUMN_CONFIG)
 
         # Biểu đồ xu hướng ROE
         st.subheader("Biểu đồ xu hướng ROE")
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(x=df['Năm'], y=df['roe'], mode='lines+markers', name='ROE %'))
-        fig.update_layout(title='Xu hướng ROE theo thời gian', xaxis_title='Năm', yaxis_title='ROE (%)')
+        # Dựng figure trong một lần gọi constructor (một lượt validate), dữ liệu dạng numpy
+        fig = go.Figure(
+            data=[go.Scatter(x=df['Năm'].to_numpy(), y=df['roe'].to_numpy(), mode='lines+markers', name='ROE %')],
+            layout=go.Layout(title='Xu hướng ROE theo thời gian', xaxis_title='Năm', yaxis_title='ROE (%)', uirevision='roe'),
+        )
         st.plotly_chart(fig, use_container_width=True)
 
     # Các kịch bản đầu tư
     st.subheader("Các kịch bản đầu tư")
     scenarios = analysis_data.get('scenarios', {})
-    for scen in ['bull', 'neutral', 'bear']:
-        sc = scenarios.get(scen, {})
-        st.markdown(f"#### Kịch bản {scen.capitalize()}")
-        st.markdown(f"- Giá mục tiêu: {fmt_number(sc.get('target_price'), 0)}")
-        st.markdown(f"- Xác suất: {fmt_number(sc.get('probability', 0) * 100, 2)}%")
-        st.markdown("- Yếu tố thúc đẩy:")
-        for d in sc.get('drivers', []):
-            st.markdown(f"  - {d}")
-        st.markdown(f"- Điều kiện vô hiệu: {sc.get('invalidations', 'N/A')}")
+    # Một bảng cho cả 3 kịch bản thay vì một khối markdown cho từng kịch bản
+    scen_list = [scenarios.get(scen, {}) for scen in SCENARIO_KEYS]
+    st.dataframe(pd.DataFrame({
+        'Kịch bản': [scen.capitalize() for scen in SCENARIO_KEYS],
+        'Giá mục tiêu': [fmt_number(sc.get('target_price'), 0) for sc in scen_list],
+        'Xác suất (%)': [fmt_number((sc.get('probability') or 0) * 100, 2) for sc in scen_list],
+        'Yếu tố thúc đẩy': [' • '.join(sc.get('drivers', [])) for sc in scen_list],
+        'Điều kiện vô hiệu': [sc.get('invalidations', 'N/A') for sc in scen_list],
+    }), use_container_width=True, hide_index=True)
 
     # Điểm nhấn và rủi ro
     st.subheader("Điểm nhấn và Rủi ro")
-    st.markdown("**Điểm nhấn chính:**")
-    for point in analysis_data.get('key_highlights', []):
-        st.markdown(f"- {point}")
-    st.markdown("**Yếu tố rủi ro:**")
-    for risk in analysis_data.get('risk_factors', []):
-        st.markdown(f"- {risk}")
+    highlights = "".join(f"\n- {point}" for point in analysis_data.get('key_highlights', []))
+    risks = "".join(f"\n- {risk}" for risk in analysis_data.get('risk_factors', []))
+    st.markdown(f"**Điểm nhấn chính:**\n{highlights}\n\n**Yếu tố rủi ro:**\n{risks}")
 
  
 
@@ -205,14 +243,22 @@ def main():
             try:
                 # Khởi tạo API và Analyst
                 fundamental_api = FundamentalAPI(symbol)
-                analyst = FundamentalAnalyst(api_key=api_key)
+                analyst = get_analyst(api_key)
 
                 # Lấy dữ liệu thị trường (tương tự MarketContext)
+                # 3 lời gọi mạng độc lập: chạy song song, thời gian chờ = lời gọi chậm nhất
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    f_income = executor.submit(fundamental_api.get_income_statement)
+                    f_balance = executor.submit(fundamental_api.get_balance_sheet)
+                    f_ratio = executor.submit(fundamental_api.get_ratio)
+                    income_df, balance_df, ratio_df = f_income.result(), f_balance.result(), f_ratio.result()
+
+                # Giữ nguyên DataFrame; analyst chỉ serialize phần cần cho prompt
                 market_data = {
                     'symbol': symbol,
-                    'income_statement': fundamental_api.get_income_statement().to_dict(orient='records'),
-                    'balance_sheet': fundamental_api.get_balance_sheet().to_dict(orient='records'),
-                    'ratios': fundamental_api.get_ratio().to_dict(orient='records'),
+                    'income_statement': income_df,
+                    'balance_sheet': balance_df,
+                    'ratios': ratio_df,
                     # Gọi compact để lấy DuPont (nếu cần, nhưng analyst sẽ xử lý)
                 }
 
@@ -1,12 +1,15 @@
 # test1.py — Golden Key | PE Percentile Valuation (AI-first) — revised with 25–99 percentiles
 
 import os
-import json
 import asyncio
+import threading
 import traceback
+from pathlib import Path
 import pandas as pd
 import streamlit as st
 
+from src.utils.config import load_config
+
 # Import nội bộ
 try:
     from src.data.pe_api import PEAPI
@@ -19,37 +22,35 @@ except ImportError as e:
 # -----------------------------
 # Helpers
 # -----------------------------
-def get_api_key():
-    
+def get_api_key(code: str) -> str:
+    # load_config được lru_cache nên config.json chỉ được đọc/parse một lần cho cả process
     try:
-        with open("config.json", "r") as f:
-            cfg = json.load(f)
-            return cfg.get(f"{code}", "")
+        return load_config(Path("config.json")).get(f"{code}", "")
     except Exception:
         return ""
 
-def ensure_event_loop():
-    # Streamlit thường có loop sẵn, cần nest_asyncio khi chạy trong notebook/thread
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            try:
-                import nest_asyncio
-                nest_asyncio.apply()
-            except Exception:
-                pass
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+@st.cache_resource
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    # Một event loop chạy mãi trên daemon thread, giữ qua các lần rerun bằng st.cache_resource
+    # (script được chạy lại mỗi lần tương tác nên không thể tạo loop ở mức module)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="pe-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def get_analyst(api_key: str, model: str) -> "PEValuationAnalyst":
+    # Giữ một analyst (và Gemini client bên trong) cho mỗi (api_key, model) qua các lần rerun
+    return PEValuationAnalyst(api_key=api_key, model=model)
 
 def run_async(coro):
-    ensure_event_loop()
-    return asyncio.run(coro)
+    # Không tạo/hủy loop mỗi lần gọi như asyncio.run, không cần nest_asyncio
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()
 
-def fmt_number(v, nd=0, default="N/A"):
+def fmt_number(v, nd=0, default=None):
+    # Số hợp lệ -> định dạng; ngược lại trả default, hoặc str(v) nếu không truyền default
     if isinstance(v, (int, float)) and pd.notna(v):
         return f"{v:,.{nd}f}"
-    return default
+    return str(v) if default is None else default
 
 def safe_percent(v, nd=1):
     try:
@@ -78,7 +79,7 @@ if not IMPORT_OK:
 with st.sidebar:
     st.header("⚙️ Cấu hình")
     code = st.text_input("Gemini API Key", value="", type="password")
-    default_api_key = get_api_key()
+    default_api_key = get_api_key(code)
     API_KEY = default_api_key
     model_name = "gemini-2.0-flash"
 
@@ -91,60 +92,76 @@ with st.sidebar:
         run_btn = st.button("🎯 Phân tích AI", type="primary", use_container_width=True)
 
 
+# Cache theo mã: rerun (bấm nút, đổi widget) không gọi lại PEAPI và không tính lại PE.
+# Chỉ trả về DataFrame + dict (picklable), không trả về instance PEAPI.
+@st.cache_data(ttl=1800, show_spinner=False)
 def load_core_data(sym: str):
     pe_api = PEAPI(sym)
-    price_df = pe_api.get_price_history()            # descending by time
-    ratio_df = pe_api.get_ratio_data()               # quarterly
-    pe_df = pe_api.compute_pe_trailing()             # merged with EPS_nam + PEtrailing
+    price_df, ratio_df = pe_api.fetch_price_ratio()  # descending by time / quarterly, fetched concurrently
+    pe_df = pe_api.compute_pe_trailing(price_df, ratio_df)  # merged with EPS_nam + PEtrailing (reuse frames above)
     stats = pe_api.calculate_pe_distribution_stats(pe_df)  # distribution statistics
-    return pe_api, price_df, ratio_df, pe_df, stats
+    return price_df, ratio_df, pe_df, stats
 
+# Đọc scalar dòng đầu (mới nhất) qua cột + .iat, không tạo Series cho cả dòng như iloc[0]
 def extract_eps_ttm(pe_df: pd.DataFrame) -> float | None:
     try:
-        return float(pe_df.iloc[0]["EPS_nam"])
+        return float(pe_df["EPS_nam"].iat[0])
     except Exception:
         return None
 
 def current_close(pe_df: pd.DataFrame) -> float | None:
     try:
-        return float(pe_df.iloc[0]["close"])
+        return float(pe_df["close"].iat[0])
     except Exception:
         return None
 
 def current_petrailing(pe_df: pd.DataFrame) -> float | None:
     try:
-        return float(pe_df.iloc[0]["PEtrailing"])
+        return float(pe_df["PEtrailing"].iat[0])
     except Exception:
         return None
 
+_METRIC_CELL_HTML = (
+    "<div style='padding:4px 0'><div style='font-size:0.875rem;opacity:0.7'>{label}</div>"
+    "<div style='font-size:1.75rem'>{value}</div></div>"
+)
+_METRIC_GRID_HTML = "<div style='display:grid;grid-template-columns:repeat(4,1fr);gap:1rem'>{cells}</div>"
+
+# Fragment: khối metrics chỉ render lại khi chính nó rerun, không theo các widget khác trên trang
+@st.fragment
 def show_distribution_metrics(stats: dict, pe_df: pd.DataFrame):
     st.subheader("📊 Phân phối PE (mô tả)")
-    c1, c2, c3, c4 = st.columns(4)
-    with c1:
-        st.metric("PE hiện tại", f"{stats.get('current_pe', 'N/A')}")
-    with c2:
-        pct = stats.get("current_percentile")
-        pct_str = f"{round(pct,1)}%" if isinstance(pct, (int,float)) else "N/A"
-        st.metric("Percentile hiện tại", pct_str)
-    with c3:
-        st.metric("PE Median (P75)", f"{stats.get('percentile_75', 'N/A')}")
-    with c4:
-        cur_px = current_close(pe_df)
-        st.metric("Giá hiện tại", f"{fmt_number(cur_px, 0) if cur_px is not None else 'N/A'}")
-
-    c5, c6, c7, c8 = st.columns(4)
-    with c5:
-        st.metric("Mean", f"{stats.get('mean','N/A')}")
-    with c6:
-        st.metric("Std", f"{stats.get('std','N/A')}")
-    with c7:
-        st.metric("Z-score hiện tại", f"{stats.get('current_z_score','N/A')}")
-    with c8:
-        st.metric("CV", f"{stats.get('coefficient_of_variation','N/A')}")
+    # PE hiện tại vẫn dùng st.metric; 7 chỉ số còn lại gộp thành một lưới HTML (một element thay vì 7)
+    st.metric("PE hiện tại", f"{stats.get('current_pe', 'N/A')}")
+
+    pct = stats.get("current_percentile")
+    cur_px = current_close(pe_df)
+    items = [
+        ("Percentile hiện tại", f"{round(pct,1)}%" if isinstance(pct, (int,float)) else "N/A"),
+        ("PE Median (P75)", f"{stats.get('percentile_75', 'N/A')}"),
+        ("Giá hiện tại", fmt_number(cur_px, 0, default="N/A")),
+        ("Mean", f"{stats.get('mean','N/A')}"),
+        ("Std", f"{stats.get('std','N/A')}"),
+        ("Z-score hiện tại", f"{stats.get('current_z_score','N/A')}"),
+        ("CV", f"{stats.get('coefficient_of_variation','N/A')}"),
+    ]
+    cells = "".join(_METRIC_CELL_HTML.format(label=label, value=value) for label, value in items)
+    st.markdown(_METRIC_GRID_HTML.format(cells=cells), unsafe_allow_html=True)
 
 
    
 
+if test_btn and not run_btn:
+    if not symbol:
+        st.error("❌ Vui lòng nhập mã hợp lệ.")
+        st.stop()
+    try:
+        # Dùng chung load_core_data (đã cache) với luồng phân tích AI
+        price_df, ratio_df, pe_df, stats = load_core_data(symbol)
+        show_distribution_metrics(stats, pe_df)
+    except Exception as e:
+        st.error(f"❌ Lỗi tải dữ liệu: {e}")
+
 if run_btn:
     if not API_KEY:
         st.error("❌ Vui lòng nhập lại code.")
@@ -156,10 +173,10 @@ if run_btn:
     status = st.empty()
     try:
 
-        pe_api, price_df, ratio_df, pe_df, stats = load_core_data(symbol)
+        price_df, ratio_df, pe_df, stats = load_core_data(symbol)
 
         ctx = MarketContext(symbol=symbol)
-        agent = PEValuationAnalyst(api_key=API_KEY, model=model_name)
+        agent = get_analyst(API_KEY, model_name)
         status.text("🎯 Phân tích định giá dựa trên phân phối PE (AI)...")
         resp = run_async(agent.analyze(ctx))
         status.text("✅ Hoàn tất phân tích")
@@ -189,7 +206,7 @@ if run_btn:
                 rows = []
                 for name, sc in scenarios.items():
                     tp_val = sc.get("target_price", "N/A")
-                    tp_str = fmt_number(tp_val, 0) if isinstance(tp_val, (int,float)) else str(tp_val)
+                    tp_str = fmt_number(tp_val, 0)
 
                     rows.append({
                         "Kịch bản": name.title(),
@@ -1,45 +1,44 @@
 # src/agents/aggregator_analyst.py
 import json
+import re
 from dataclasses import dataclass, field
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
+import orjson
 
-@dataclass
-class AggregationResult:
-    overall_rating: str = "HOLD"
-    target_price: float = 0.0
-    confidence_level: float = 0.5
-    time_horizon: str = "N/A"
-    rationale: str = "Không có đủ thông tin."
-    risk_factors: list = field(default_factory=list)
-    key_highlights: list = field(default_factory=list)
-    investment_score: float = 50.0
-    raw_content: dict = field(default_factory=dict)
+from src.utils.gemini import get_model
 
-class AggregatorAnalyst:
-    """AI Agent tổng hợp, đóng vai trò CIO (đồng bộ)."""
-    def __init__(self, api_key: str, model: str = "gemini-2.0-flash"):
-        self.api_key = api_key
-        self.model = model
-        genai.configure(api_key=api_key)
-        self.client = genai.GenerativeModel(model)
-    
-    def analyze(self, fundamental_result, technical_result, pe_valuation_result, symbol) -> AggregationResult:
-        prompt = self._create_aggregation_prompt(symbol, fundamental_result, technical_result, pe_valuation_result)
-        ai_text = self._call_ai(prompt)
-        return self._parse_response(ai_text)
-    
-    def _create_aggregation_prompt(self, symbol, fundamental, technical, pe_valuation) -> str:
-        fundamental_json = json.dumps(fundamental, ensure_ascii=False, indent=2)
-        technical_json = json.dumps(technical, ensure_ascii=False, indent=2)
-        pe_valuation_json = json.dumps(pe_valuation, ensure_ascii=False, indent=2)
-        
-        # Sửa lỗi SyntaxError: Nhân đôi các dấu ngoặc nhọn {{ }} để chúng không bị f-string xử lý
-        return f"""
+# Token có ý nghĩa khi dò biên JSON: cặp escape (\ + 1 ký tự), dấu nháy và ngoặc nhọn.
+# finditer nhảy qua văn bản thường ở tầng C thay vì duyệt từng ký tự bằng Python.
+_JSON_TOKEN_RE = re.compile(r'\\.|[{}"]', re.S)
+
+def _find_json_span(text: str) -> Tuple[int, int]:
+    """
+    Quét một lượt từ trái sang, theo dõi độ sâu ngoặc nhọn (bỏ qua ngoặc trong chuỗi)
+    để lấy vị trí [start, end) của object JSON đầu tiên. Trả về (-1, -1) nếu không có.
+    """
+    start = text.find('{')
+    if start == -1:
+        return -1, -1
+    depth = 0
+    in_string = False
+    for m in _JSON_TOKEN_RE.finditer(text, start):
+        c = m.group()
+        if c == '"':
+            in_string = not in_string
+        elif in_string or len(c) > 1:
+            continue
+        elif c == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return start, m.end()
+    # JSON không khép kín (vd. bị cắt) -> giữ hành vi cũ: tới dấu '}' cuối cùng
+    return start, text.rfind('}') + 1
+
+# Prompt CIO dựng sẵn một lần; ngoặc nhọn của khung JSON được nhân đôi {{ }} để str.format bỏ qua
+_PROMPT_TEMPLATE = """
 Bạn là Giám đốc Đầu tư (CIO) của một quỹ đầu tư hàng đầu. Nhiệm vụ của bạn là tổng hợp báo cáo từ ba bộ phận phân tích để đưa ra quyết định đầu tư cuối cùng cho mã cổ phiếu {symbol}.
 
 **Nguyên tắc chỉ đạo:**
@@ -76,19 +75,62 @@ Tổng hợp thông tin và điền vào cấu trúc JSON sau (KHÔNG thay đổ
   }}
 }}
 ```"""
+
+def _dumps_compact(data) -> str:
+    """Serialize báo cáo đầu vào dạng JSON gọn (không indent, giữ nguyên tiếng Việt) bằng orjson.
+    Bỏ khoảng trắng giúp giảm token đầu vào; model đọc JSON gọn như JSON có indent."""
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+
+@dataclass
+class AggregationResult:
+    overall_rating: str = "HOLD"
+    target_price: float = 0.0
+    confidence_level: float = 0.5
+    time_horizon: str = "N/A"
+    rationale: str = "Không có đủ thông tin."
+    risk_factors: list = field(default_factory=list)
+    key_highlights: list = field(default_factory=list)
+    investment_score: float = 50.0
+    raw_content: dict = field(default_factory=dict)
+
+class AggregatorAnalyst:
+    """AI Agent tổng hợp, đóng vai trò CIO (đồng bộ)."""
+    def __init__(self, api_key: str, model: str = "gemini-2.0-flash"):
+        self.api_key = api_key
+        self.model = model
+        self.client = get_model(api_key, model)
+    
+    def analyze(self, fundamental_result, technical_result, pe_valuation_result, symbol) -> AggregationResult:
+        prompt = self._create_aggregation_prompt(symbol, fundamental_result, technical_result, pe_valuation_result)
+        ai_text = self._call_ai(prompt)
+        return self._parse_response(ai_text)
+    
+    def _create_aggregation_prompt(self, symbol, fundamental, technical, pe_valuation) -> str:
+        return _PROMPT_TEMPLATE.format(
+            symbol=symbol,
+            fundamental_json=_dumps_compact(fundamental),
+            technical_json=_dumps_compact(technical),
+            pe_valuation_json=_dumps_compact(pe_valuation),
+        )
     
     def _call_ai(self, prompt: str) -> str:
         try:
-            response = self.client.generate_content(prompt, generation_config={"temperature": 0.2})
-            return response.text
+            # Stream để nhận từng phần ngay khi model sinh ra, rồi ghép lại
+            parts = []
+            for chunk in self.client.generate_content(prompt, stream=True, generation_config={"temperature": 0.2}):
+                parts.append(chunk.text)
+            return "".join(parts)
         except Exception as e:
             return json.dumps({"error": f"Lỗi gọi API của AI: {e}"})
 
     def _parse_response(self, text: str) -> AggregationResult:
         try:
-            start, end = text.find('{'), text.rfind('}') + 1
+            start, end = _find_json_span(text)
             if start == -1: raise ValueError("Không tìm thấy JSON.")
-            data = json.loads(text[start:end])
+            try:
+                data = orjson.loads(text[start:end])
+            except orjson.JSONDecodeError:
+                data = json.loads(text[start:end])
             
             if "error" in data:
                 return AggregationResult(overall_rating="ERROR", rationale=data["error"], raw_content=data)
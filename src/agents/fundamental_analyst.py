@@ -9,30 +9,37 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional, Any, Union
+from typing import AsyncIterator, Callable, Dict, List, Optional, Any
 import asyncio
-import json
+import numpy as np
+import orjson
 import pandas as pd
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
-
 # Import from fundamental_api.py (assuming it's in the same directory)
 from src.data.fundamental_api import FundamentalAPI  # Adjust import if needed
+from src.utils.batch import BatchAnalysisMixin
+from src.utils.cache import api_cache
+from src.utils.gemini import cached_response, cached_stream, get_model, import_genai
+from src.utils.streaming import aiter_in_thread
 
-@dataclass
+@dataclass(slots=True)
 class MarketContext:
     """Market context used as input for AI analysis."""
     symbol: str
     current_price: Optional[float] = None
     market_data: Optional[Dict[str, Any]] = None
-    timestamp: datetime = field(default_factory=datetime.now)
+    _timestamp: Optional[datetime] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self) -> None:
         self.symbol = self.symbol.upper().strip()
 
+    @property
+    def timestamp(self) -> datetime:
+        """Timestamp of the analysis, taken on first access (slots dataclass, so no cached_property)."""
+        if self._timestamp is None:
+            self._timestamp = datetime.now()
+        return self._timestamp
+
 @dataclass
 class AnalysisResponse:
     """Standardized analysis result for UI consumption."""
@@ -43,120 +50,37 @@ class AnalysisResponse:
     concerns: Optional[List[str]] = None
     content: Optional[Dict[str, Any]] = None
 
-def make_json_serializable(obj: Union[Dict, List, Any]) -> Union[Dict, List, Any]:
-    """Recursively convert non-serializable types (e.g., Timestamp) in dict/list to JSON-friendly formats."""
-    if isinstance(obj, dict):
-        return {k: make_json_serializable(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [make_json_serializable(item) for item in obj]
-    elif isinstance(obj, pd.Timestamp) or isinstance(obj, datetime):
-        return obj.isoformat()
-    return obj
-
-def json_serializable_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
-    """Convert DataFrame to list of dicts with Timestamp converted to ISO string."""
-    def convert_value(v: Any) -> Any:
-        if isinstance(v, pd.Timestamp) or isinstance(v, datetime):
-            return v.isoformat()
-        return v
-    records = df.to_dict(orient='records')
-    for r in records:
-        for k, v in r.items():
-            r[k] = convert_value(v)
-    return records
-
-class FundamentalAnalyst:
-    """AI Agent specialized in fundamental analysis using DuPont method."""
-    
-    def __init__(self, api_key: str, model: str = 'gemini-2.0-flash') -> None:
-        if not genai:
-            raise ImportError("google-generativeai not installed. Install with: pip install google-generativeai")
-        self.api_key = api_key
-        self.model = model
-        genai.configure(api_key=api_key)
-        self.client = genai.GenerativeModel(model)
+def records_fragment(df: pd.DataFrame) -> orjson.Fragment:
+    """Serialize a DataFrame to a JSON records array (ISO dates, UTF-8 kept) wrapped as an orjson.Fragment."""
+    return orjson.Fragment(df.to_json(orient='records', date_format='iso', force_ascii=False))
 
-    async def analyze(self, context: MarketContext) -> AnalysisResponse:
-        """Perform DuPont-based fundamental analysis based on context's market_data."""
-        # Steps: Compact data, Create prompt, Call AI asynchronously, Parse response
-        data_for_ai = self.compact_market_data(context)
-        prompt = self.create_prompt(data_for_ai)
-        ai_text = await self.call_ai_async(prompt)
-        return self.parse_response(ai_text)
-
-    def compact_market_data(self, context: MarketContext) -> Dict[str, Any]:
-        """Compress raw data tables for prompt embedding, ensuring brevity and JSON serializability."""
-        md = context.market_data or {}
-        ts = md.get('timestamp', datetime.now().strftime('%Y-%m-%d'))
+def compact_numeric(df: pd.DataFrame, decimals: int = 4, relabel_money: bool = False) -> pd.DataFrame:
+    """
+    Round every numeric column so the prompt carries fewer digits/tokens; values are not rescaled.
 
-        # Use fundamental_api to fetch data
-        api = FundamentalAPI(context.symbol)
-        income = api.get_income_statement()
-        balance = api.get_balance_sheet()
-        ratios = api.get_ratio()
-
-        # Compute DuPont components with rolling 4 quarters (TTM) and correct column names
-        dupont_data = self.compute_rolling_dupont(income, balance)
+    FundamentalAPI already divides statement amounts by 1e9 (tỷ đồng) but keeps vnstock's "(đồng)"
+    label; relabel_money renames it to "(tỷ đồng)" so the label matches the value.
+    """
+    num_cols = [c for c in df.select_dtypes('number').columns if c not in ('Năm', 'Kỳ')]
+    out = df.copy()
+    if num_cols:
+        out[num_cols] = out[num_cols].round(decimals)
+    if relabel_money:
+        out = out.rename(columns=lambda c: c.replace('(đồng)', '(tỷ đồng)') if isinstance(c, str) else c)
+    return out
 
-        income_compact = json_serializable_records(income.tail(8))  # Last 8 quarters/years
-        balance_compact = json_serializable_records(balance.tail(8))
-        ratios_compact = json_serializable_records(ratios.tail(8))
-        dupont_compact = json_serializable_records(dupont_data)  # Already a DataFrame
-
-        return {
-            'symbol': context.symbol,
-            'latest_price': context.current_price,
-            'timestamp': ts,
-            'income_statement': income_compact,
-            'balance_sheet': balance_compact,
-            'ratios': ratios_compact,
-            'dupont_components': dupont_compact  # Pre-computed rolling DuPont for AI to analyze
-        }
-
-    def compute_rolling_dupont(self, income: pd.DataFrame, balance: pd.DataFrame) -> pd.DataFrame:
-        """Compute rolling 4-quarter (TTM) DuPont components with correct column names."""
-        # Merge income and balance on Năm, Kỳ
-        df = pd.merge(income, balance, on=['CP', 'Năm', 'Kỳ'], how='inner')
-        
-        # Sort by Năm, Kỳ ascending for rolling calculations
-        df = df.sort_values(['Năm', 'Kỳ'])
-        
-        # Ensure numeric types
-        income_cols = ['Doanh thu thuần', 'Lợi nhuận sau thuế của Cổ đông công ty mẹ (đồng)']
-        balance_cols = ['TỔNG CỘNG TÀI SẢN (đồng)', 'VỐN CHỦ SỞ HỮU (đồng)']
-        for col in income_cols + balance_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        
-        # Calculate TTM sums for income items
-        df['revenue_ttm'] = df['Doanh thu thuần'].rolling(window=4, min_periods=1).sum()
-        df['net_income_ttm'] = df['Lợi nhuận sau thuế của Cổ đông công ty mẹ (đồng)'].rolling(window=4, min_periods=1).sum()
-        
-        # For assets and equity, use average over the period (simple end-of-quarter average for rolling)
-        df['avg_assets_ttm'] = df['TỔNG CỘNG TÀI SẢN (đồng)'].rolling(window=4, min_periods=1).mean()
-        df['avg_equity_ttm'] = df['VỐN CHỦ SỞ HỮU (đồng)'].rolling(window=4, min_periods=1).mean()
-        
-        # DuPont components (TTM)
-        df['profit_margin'] = (df['net_income_ttm'] / df['revenue_ttm']) * 100  # %
-        df['asset_turnover'] = df['revenue_ttm'] / df['avg_assets_ttm']
-        df['equity_multiplier'] = df['avg_assets_ttm'] / df['avg_equity_ttm']
-        df['roe'] = (df['profit_margin'] / 100) * df['asset_turnover'] * df['equity_multiplier'] * 100  # %
-        
-        # Round and handle NaN
-        for col in ['profit_margin', 'asset_turnover', 'equity_multiplier', 'roe']:
-            df[col] = df[col].round(2).fillna(0)
-        
-        # Return relevant columns, sorted descending for recent first
-        result = df[['Năm', 'Kỳ', 'profit_margin', 'asset_turnover', 'equity_multiplier', 'roe']]
-        return result.sort_values(['Năm', 'Kỳ'], ascending=[False, False])
+def _orjson_default(obj: Any) -> Any:
+    """Fallback for orjson: Timestamp/datetime subclasses -> ISO string, anything else -> str."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
 
-    def create_prompt(self, data: Dict) -> str:
-        """Create a structured prompt for DuPont analysis."""
-        symbol = data.get('symbol', 'N/A')
-        latest_price = data.get('latest_price', 'N/A')
-        data_json = json.dumps(data, ensure_ascii=False, indent=2)
+# Options for prompt JSON: compact (no indent, whitespace only costs input tokens),
+# numpy scalars/arrays and non-str keys handled in C
+PROMPT_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
 
-        prompt_template = f"""
+# DuPont prompt, built once at import; JSON-skeleton braces are doubled {{ }} for str.format
+PROMPT_TEMPLATE = """
 Bạn là một chuyên gia phân tích cơ bản cấp cao tại quỹ đầu tư lớn nhất Việt Nam, với hơn 20 năm kinh nghiệm phân tích cổ phiếu HOSE. 
 Bạn chuyên sâu về phương pháp DuPont để phân tích ROE, tập trung vào việc phân tích xu hướng, rủi ro và khuyến nghị đầu tư.
 
@@ -164,6 +88,7 @@ Dữ liệu đầu vào:
 - Mã cổ phiếu: {symbol}
 - Giá hiện tại: {latest_price} nghìn VND
 - Dữ liệu bảng (compact và serialized): {data_json}
+- Đơn vị: số tiền trong income_statement và balance_sheet tính bằng tỷ VND (cột ghi "(tỷ đồng)" hoặc không ghi đơn vị, trừ cột %); ratios theo đơn vị ghi trong tên cột
 
 Yêu cầu phân tích:
 Thực hiện phân tích chuyên sâu theo phương pháp DuPont với dữ liệu rolling 4 quý (TTM). Tập trung vào:
@@ -209,14 +134,168 @@ Hướng dẫn tính toán và phân tích:
 - Target price dựa trên ROE dự báo và định giá cơ bản và dựa vào EV/EBITDA và Số CP lưu hành (Triệu CP)
 - JSON phải hợp lệ, đầy đủ, và chỉ dựa trên dữ liệu cung cấp (giá nghìn VND).
 """
-        return prompt_template
+
+class FundamentalAnalyst(BatchAnalysisMixin):
+    """AI Agent specialized in fundamental analysis using DuPont method."""
+    
+    def __init__(self, api_key: str, model: str = 'gemini-2.0-flash') -> None:
+        if not import_genai():
+            raise ImportError("google-generativeai not installed. Install with: pip install google-generativeai")
+        self.api_key = api_key
+        self.model = model
+        self.client = get_model(api_key, model)
+
+    async def analyze(self, context: MarketContext, on_chunk: Optional[Callable[[str], None]] = None) -> AnalysisResponse:
+        """Perform DuPont-based fundamental analysis based on context's market_data."""
+        # Steps: Compact data, Create prompt, Call AI asynchronously, Parse response
+        # Nếu có on_chunk: stream phản hồi, gọi on_chunk cho từng đoạn, parse JSON một lần ở cuối
+        if on_chunk is not None:
+            parts: List[str] = []
+            async for piece in self.analyze_stream(context):
+                parts.append(piece)
+                on_chunk(piece)
+            return self.parse_response("".join(parts))
+
+        data_for_ai = await self.compact_market_data(context)
+        prompt = self.create_prompt(data_for_ai)
+        ai_text = await self.call_ai_async(prompt)
+        return self.parse_response(ai_text)
+
+    async def analyze_stream(self, context: MarketContext) -> AsyncIterator[str]:
+        """Same prompt as analyze(), but yields raw text chunks as Gemini streams them."""
+        data_for_ai = await self.compact_market_data(context)
+        prompt = self.create_prompt(data_for_ai)
+        async for piece in self.stream_ai_async(prompt):
+            yield piece
+
+    async def compact_market_data(self, context: MarketContext) -> Dict[str, Any]:
+        """Compress raw data tables for prompt embedding, ensuring brevity and JSON serializability."""
+        md = context.market_data or {}
+        # Fallback evaluated only when needed, from the context's single (lazy) timestamp
+        ts = md.get('timestamp') or context.timestamp.strftime('%Y-%m-%d')
+
+        # Use DataFrames already in market_data; only fetch from fundamental_api what is missing
+        income, balance, ratios = (md.get(key) for key in ('income_statement', 'balance_sheet', 'ratios'))
+        if not all(isinstance(df, pd.DataFrame) for df in (income, balance, ratios)):
+            api = FundamentalAPI(context.symbol)
+
+            async def fetch(current: Any, endpoint: str, getter: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+                if isinstance(current, pd.DataFrame):
+                    return current
+                # Cache TTL theo (symbol, endpoint): các lần phân tích sau đọc từ bộ nhớ/đĩa thay vì gọi mạng.
+                # Chạy trong thread để các request blocking không chặn event loop và chạy song song với nhau
+                return await asyncio.to_thread(api_cache.get_or_compute, context.symbol, endpoint, getter)
+
+            income, balance, ratios = await asyncio.gather(
+                fetch(income, "income", api.get_income_statement),
+                fetch(balance, "balance", api.get_balance_sheet),
+                fetch(ratios, "ratio", api.get_ratio),
+            )
+
+        # Compute DuPont components with rolling 4 quarters (TTM) and correct column names
+        dupont_data = self.compute_rolling_dupont(income, balance)
+
+        # Tables are serialized by pandas in C (timestamps -> ISO) and embedded as pre-serialized
+        # orjson fragments, so create_prompt does not decode/re-encode them
+        income_compact = records_fragment(compact_numeric(income.tail(8), 2, relabel_money=True))  # Last 8 quarters/years
+        balance_compact = records_fragment(compact_numeric(balance.tail(8), 2, relabel_money=True))
+        ratios_compact = records_fragment(compact_numeric(ratios.tail(8)))
+        dupont_compact = records_fragment(dupont_data)  # Already a DataFrame
+
+        return {
+            'symbol': context.symbol,
+            'latest_price': context.current_price,
+            'timestamp': ts,
+            'income_statement': income_compact,
+            'balance_sheet': balance_compact,
+            'ratios': ratios_compact,
+            'dupont_components': dupont_compact  # Pre-computed rolling DuPont for AI to analyze
+        }
+
+    def compute_rolling_dupont(self, income: pd.DataFrame, balance: pd.DataFrame) -> pd.DataFrame:
+        """Compute rolling 4-quarter (TTM) DuPont components with correct column names."""
+        # Join income and balance on (CP, Năm, Kỳ): sort income once by Năm, Kỳ ascending for rolling
+        # calculations; the inner index join keeps the left (income) order, so no sort after the join
+        keys = ['CP', 'Năm', 'Kỳ']
+        df = (
+            income.sort_values(['Năm', 'Kỳ']).set_index(keys)
+            .join(balance.set_index(keys), how='inner', rsuffix='_b')
+            .reset_index()
+        )
+        
+        # Ensure numeric types: extract the four inputs once into a float64 (n, 4) array, NaN -> 0
+        income_cols = ['Doanh thu thuần', 'Lợi nhuận sau thuế của Cổ đông công ty mẹ (đồng)']
+        balance_cols = ['TỔNG CỘNG TÀI SẢN (đồng)', 'VỐN CHỦ SỞ HỮU (đồng)']
+        arr = np.column_stack([
+            pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64)
+            for col in income_cols + balance_cols
+        ])
+        arr[np.isnan(arr)] = 0.0
+        
+        # TTM (4 quý, min_periods=1) trên mảng numpy: tổng trượt = hiệu của cumsum, không dùng rolling của pandas
+        n = len(arr)
+        csum = np.vstack([np.zeros((1, arr.shape[1])), np.cumsum(arr, axis=0)])
+        lower = np.maximum(np.arange(1, n + 1) - 4, 0)
+        window_sum = csum[1:] - csum[lower]
+        window_len = np.minimum(np.arange(1, n + 1), 4)[:, None]
+
+        revenue_ttm, net_income_ttm = window_sum[:, 0], window_sum[:, 1]
+        # For assets and equity, use average over the period (simple end-of-quarter average for rolling)
+        avg_assets_ttm, avg_equity_ttm = (window_sum[:, 2:] / window_len).T
+
+        # DuPont components (TTM)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profit_margin = (net_income_ttm / revenue_ttm) * 100  # %
+            asset_turnover = revenue_ttm / avg_assets_ttm
+            equity_multiplier = avg_assets_ttm / avg_equity_ttm
+            roe = (profit_margin / 100) * asset_turnover * equity_multiplier * 100  # %
+
+        # Round and handle NaN
+        components = np.column_stack([profit_margin, asset_turnover, equity_multiplier, roe]).round(2)
+        components[np.isnan(components)] = 0.0
+        
+        # Build the result straight from the arrays, reversed (rows are ascending) so recent comes first
+        return pd.DataFrame({
+            'Năm': df['Năm'].to_numpy()[::-1],
+            'Kỳ': df['Kỳ'].to_numpy()[::-1],
+            'profit_margin': components[::-1, 0],
+            'asset_turnover': components[::-1, 1],
+            'equity_multiplier': components[::-1, 2],
+            'roe': components[::-1, 3],
+        })
+
+    def create_prompt(self, data: Dict) -> str:
+        """Create a structured prompt for DuPont analysis."""
+        return PROMPT_TEMPLATE.format(
+            symbol=data.get('symbol', 'N/A'),
+            latest_price=data.get('latest_price', 'N/A'),
+            data_json=orjson.dumps(data, default=_orjson_default, option=PROMPT_JSON_OPTIONS).decode(),
+        )
 
     async def call_ai_async(self, prompt: str) -> str:
         """Asynchronous call to Gemini API, expecting JSON text."""
+        async def _request() -> str:
+            try:
+                # Sync client in a worker thread: the shared model is used from several event loops
+                # (per-thread page loops, the background loop), which the SDK's grpc.aio client cannot serve
+                resp = await asyncio.to_thread(self.client.generate_content, prompt, generation_config={'temperature': 0.3})
+                return resp.text
+            except Exception as e:
+                raise RuntimeError(f"AI API call failed: {e}") from e
+
+        # Identical prompt within the TTL (refresh / retry) -> cached text, no Gemini call
+        return await cached_response(self.model, prompt, _request)
+
+    async def stream_ai_async(self, prompt: str) -> AsyncIterator[str]:
+        """Streaming call to Gemini API (stream=True), yielding text chunks."""
+        def _chunks():
+            stream = self.client.generate_content(prompt, generation_config={'temperature': 0.3}, stream=True)
+            return (chunk.text for chunk in stream)
+
         try:
-            loop = asyncio.get_event_loop()
-            resp = await loop.run_in_executor(None, lambda: self.client.generate_content(prompt, generation_config={'temperature': 0.3}))
-            return resp.text
+            # Cache hit (same prompt within the TTL) -> replay the cached text, no Gemini call
+            async for piece in cached_stream(self.model, prompt, lambda: aiter_in_thread(_chunks)):
+                yield piece
         except Exception as e:
             raise RuntimeError(f"AI API call failed: {e}") from e
 
@@ -227,7 +306,7 @@ Hướng dẫn tính toán và phân tích:
             end = response_text.rfind('}') + 1
             if start == -1 or end <= start:
                 raise ValueError("No JSON found in response.")
-            data = json.loads(response_text[start:end])
+            data = orjson.loads(response_text[start:end])
             strat = data.get('strategy_recommendation', {})
             action = strat.get('action', 'N/A')
             conf = data.get('data_quality', {}).get('confidence_level', 'Trung bình')
@@ -1,74 +1,119 @@
+from dataclasses import dataclass, field
 from datetime import datetime
 import asyncio
-from typing import Dict, List, Optional, Any
-import json
+from typing import AsyncIterator, Callable, Dict, List, Optional, Any
+import orjson
 import pandas as pd
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    print("Warning: google-generativeai not installed. Please install it with: pip install google-generativeai")
-    genai = None
+from src.data.pe_api import PEAPI, DataProcessor
+from src.utils.batch import BatchAnalysisMixin
+from src.utils.cache import price_cache
+from src.utils.gemini import cached_response, cached_stream, get_model, import_genai
+from src.utils.streaming import aiter_in_thread
 
-from src.data.pe_api import PEAPI
+def _orjson_default(obj: Any) -> Any:
+    """Fallback cho orjson: Timestamp/datetime -> chuỗi ISO, kiểu khác -> str"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
 
+# Tùy chọn JSON cho prompt: compact (không indent, khoảng trắng chỉ tốn token đầu vào),
+# numpy scalar/array và key không phải str được xử lý trong C
+PROMPT_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+@dataclass(slots=True)
 class MarketContext:
     """Context chứa thông tin thị trường cần thiết cho phân tích"""
-    def __init__(self, symbol: str, current_price: Optional[float] = None, market_data: Optional[Dict] = None):
-        self.symbol = symbol.upper()
-        self.current_price = current_price
-        self.market_data = market_data or {}
-        self.timestamp = datetime.now()
+    symbol: str
+    current_price: Optional[float] = None
+    market_data: Optional[Dict] = None
+    _timestamp: Optional[datetime] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.symbol = self.symbol.upper()
+        if self.market_data is None:
+            self.market_data = {}
+
+    @property
+    def timestamp(self) -> datetime:
+        """Thời điểm phân tích, chỉ gọi datetime.now() khi được truy cập lần đầu"""
+        if self._timestamp is None:
+            self._timestamp = datetime.now()
+        return self._timestamp
 
+@dataclass(slots=True)
 class AnalysisResponse:
     """Response object chứa kết quả phân tích"""
-    def __init__(self,
-                 recommendation: Optional[str] = None,
-                 confidence_level: Optional[float] = None,
-                 data_quality: Optional[float] = None,
-                 key_points: Optional[List[str]] = None,
-                 concerns: Optional[List[str]] = None,
-                 content: Optional[Dict] = None):
-        self.recommendation = recommendation
-        self.confidence_level = confidence_level
-        self.data_quality = data_quality
-        self.key_points = key_points or []
-        self.concerns = concerns or []
-        self.content = content or {}
-
-class PEValuationAnalyst:
+    recommendation: Optional[str] = None
+    confidence_level: Optional[float] = None
+    data_quality: Optional[float] = None
+    key_points: Optional[List[str]] = None
+    concerns: Optional[List[str]] = None
+    content: Optional[Dict] = None
+
+    def __post_init__(self) -> None:
+        # Giữ hành vi cũ: None (hoặc rỗng) -> list/dict rỗng
+        self.key_points = self.key_points or []
+        self.concerns = self.concerns or []
+        self.content = self.content or {}
+
+class PEValuationAnalyst(BatchAnalysisMixin):
     """Agent chuyên về phân tích định giá PE"""
     def __init__(self, api_key: str, model: str = "gemini-2.0-flash"):
-        if not genai:
+        if not import_genai():
             raise ImportError("google-generativeai not installed. Please install it with: pip install google-generativeai")
         self.api_key = api_key
         self.model = model
-        genai.configure(api_key=api_key)
-        self.client = genai.GenerativeModel(model)
+        self.client = get_model(api_key, model)
 
-    async def analyze(self, context: MarketContext) -> AnalysisResponse:
+    async def analyze(self, context: MarketContext, on_chunk: Optional[Callable[[str], None]] = None) -> AnalysisResponse:
         """Thực hiện phân tích định giá PE cho cổ phiếu"""
-        pe_api = PEAPI(context.symbol)
-        petrailing_df = pe_api.compute_pe_trailing()
-        distribution_stats = pe_api.calculate_pe_distribution_stats(petrailing_df)
+        if on_chunk is not None:
+            # Stream phản hồi qua on_chunk, parse JSON một lần khi đã nhận đủ
+            parts: List[str] = []
+            async for piece in self.analyze_stream(context):
+                parts.append(piece)
+                on_chunk(piece)
+            return self._parse_response("".join(parts))
+
+        # PE trailing khi cache miss gọi VNStock (blocking) -> chạy trong thread để không chặn event loop
+        prompt = await asyncio.to_thread(self._build_prompt, context)
+        response = await self._call_ai_async(prompt)
+        result = self._parse_response(response)
+        return result
+
+    async def analyze_stream(self, context: MarketContext) -> AsyncIterator[str]:
+        """Giống analyze() nhưng trả về từng đoạn text thô khi Gemini stream"""
+        prompt = await asyncio.to_thread(self._build_prompt, context)
+        async for piece in self._stream_ai_async(prompt):
+            yield piece
+
+    def _build_prompt(self, context: MarketContext) -> str:
+        """Tính PE trailing + thống kê phân phối và tạo prompt"""
+        # PEAPI (Quote/Finance) chỉ được khởi tạo khi cache miss
+        petrailing_df = price_cache.get_or_compute(
+            context.symbol, "pe_trailing", lambda: PEAPI(context.symbol).compute_pe_trailing()
+        )
+        distribution_stats = price_cache.get_or_compute(
+            context.symbol, "pe_distribution_stats",
+            lambda: DataProcessor.calculate_pe_distribution_stats(petrailing_df),
+        )
 
         analysis_data = {
             "symbol": context.symbol,
-            "data_analyst": self._safe_convert_to_dict(petrailing_df, limit=1200),
+            # Model chỉ cần distribution_stats + PE hiện tại; gửi thêm chuỗi ngắn 20 tuần gần nhất làm bối cảnh xu hướng
+            "recent_pe": self._safe_convert_to_json(petrailing_df, limit=20),
             "distribution_stats": distribution_stats,
             "latest_price": self._safe_get_latest_price(petrailing_df),
             "latest_pe": self._safe_calculate_pe_stats(petrailing_df)
         }
 
-        prompt = self._create_analysis_prompt(analysis_data)
-        response = await self._call_ai_async(prompt)
-        result = self._parse_response(response)
-        return result
+        return self._create_analysis_prompt(analysis_data)
 
     def _safe_calculate_pe_stats(self, df: pd.DataFrame) -> float:
         """Lấy PE hiện tại an toàn"""
         try:
-            return float(df.iloc[0]["PE_trailing"])
+            return float(df.iloc[0]["PEtrailing"])
         except Exception:
             return float('nan')
 
@@ -79,22 +124,35 @@ class PEValuationAnalyst:
         except Exception:
             return None
 
-    def _safe_convert_to_dict(self, df: pd.DataFrame, limit: int = 1000) -> List[Dict[str, Any]]:
-        """Chuyển DataFrame thành dict an toàn"""
+    def _safe_convert_to_json(self, df: pd.DataFrame, limit: int = 120) -> str:
+        """Chuyển DataFrame thành chuỗi JSON records an toàn (pandas serialize trong C, không qua list dict),
+        gộp theo tuần (giá/PE cuối tuần) và giữ `limit` tuần gần nhất"""
         try:
-            cols_to_include = ["time", "close", "PE_trailing"]
-            df_limit = df[cols_to_include].head(limit)
-            return df_limit.to_dict(orient="records")
+            cols_to_include = ["time", "close", "PEtrailing"]
+            weekly = (
+                df[cols_to_include]
+                .assign(time=pd.to_datetime(df["time"]))
+                .set_index("time")
+                .sort_index()
+                .replace([float("inf"), float("-inf")], float("nan"))
+                .resample("W").last()
+                .dropna()
+                .tail(limit)
+                .round(2)  # Giá và PE 2 chữ số thập phân là đủ, giảm số token trong prompt
+            )
+            weekly.index = weekly.index.strftime("%Y-%m-%d")
+            # Giữ thứ tự cũ: mới nhất ở đầu
+            return weekly.iloc[::-1].reset_index().to_json(orient="records", force_ascii=False)
         except Exception:
-            return []
+            return "[]"
 
     def _create_analysis_prompt(self, data: Dict) -> str:
         """Tạo prompt phân tích với kịch bản do AI tự đưa ra"""
         symbol = data.get("symbol", "N/A")
         latest_price = data.get("latest_price", "N/A")
         latest_pe = data.get("latest_pe", "null")
-        dist_stats = json.dumps(data.get("distribution_stats", {}), ensure_ascii=False, indent=2)
-        data_analyst = json.dumps(data.get("data_analyst", []), ensure_ascii=False, indent=2)
+        dist_stats = orjson.dumps(data.get("distribution_stats", {}), default=_orjson_default, option=PROMPT_JSON_OPTIONS).decode()
+        recent_pe = data.get("recent_pe", "[]")  # Đã là chuỗi JSON, chèn thẳng vào prompt
 
         prompt_template = f"""
             Bạn là một chuyên gia phân tích tài chính cấp cao tại quỹ đầu tư lớn nhất Việt Nam, với hơn 15 năm kinh nghiệm phân tích cổ phiếu HOSE.
@@ -107,8 +165,8 @@ class PEValuationAnalyst:
             **Thống kê phân phối PE Trailing (sẵn có):**
             {dist_stats}
 
-            **Dữ liệu bảng lịch sử PE:**
-            {data_analyst}
+            **Diễn biến PE gần đây (20 tuần, mới nhất trước):**
+            {recent_pe}
 
             **Yêu cầu phân tích:**
             Thực hiện phân tích định giá chuyên sâu dựa trên dữ liệu, đúng cấu trúc JSON chuẩn sau (KHÔNG ĐƯỢC THÊM/BỚT bất kỳ trường nào!).
@@ -174,10 +232,28 @@ class PEValuationAnalyst:
 
     async def _call_ai_async(self, prompt: str) -> str:
         """Gọi AI API bất đồng bộ"""
+        async def _request() -> str:
+            try:
+                # Client sync trong worker thread: model dùng chung được gọi từ nhiều event loop
+                # (loop theo thread của các trang, loop nền) mà client grpc.aio của SDK không phục vụ được
+                response = await asyncio.to_thread(self.client.generate_content, prompt)
+                return response.text
+            except Exception as e:
+                raise Exception(f"AI API call failed: {str(e)}")
+
+        # Prompt giống hệt trong TTL (refresh / bấm lại) -> trả text đã cache, không gọi Gemini
+        return await cached_response(self.model, prompt, _request)
+
+    async def _stream_ai_async(self, prompt: str) -> AsyncIterator[str]:
+        """Gọi AI API dạng stream (stream=True), trả về từng đoạn text"""
+        def _chunks():
+            stream = self.client.generate_content(prompt, stream=True)
+            return (chunk.text for chunk in stream)
+
         try:
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: self.client.generate_content(prompt))
-            return response.text
+            # Cache hit (cùng prompt trong TTL) -> phát lại text đã cache, không gọi Gemini
+            async for piece in cached_stream(self.model, prompt, lambda: aiter_in_thread(_chunks)):
+                yield piece
         except Exception as e:
             raise Exception(f"AI API call failed: {str(e)}")
 
@@ -189,7 +265,7 @@ class PEValuationAnalyst:
             if start_idx == -1 or end_idx == 0:
                 raise ValueError("No JSON found in response")
             json_text = response_text[start_idx:end_idx]
-            data = json.loads(json_text)
+            data = orjson.loads(json_text)
             recommendation = data.get("strategy_recommendation", {}).get("reasoning", "N/A")
             reliability = data.get("reliability_score", 50)
             confidence = float(reliability) if isinstance(reliability, (int, float)) else 50.0
@@ -17,30 +17,39 @@ Core Components:
 from __future__ import annotations
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional, Any, Union
+from typing import AsyncIterator, Callable, Dict, List, Optional, Any, Tuple
 import asyncio
 import json
 import math
+import weakref
 
+import orjson
 import pandas as pd
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
+from src.utils.gemini import cached_response, cached_stream, get_model, import_genai
+from src.utils.streaming import aiter_in_thread
 
+_JSON_DECODER = json.JSONDecoder()
 
-@dataclass
+
+@dataclass(slots=True)
 class MarketContext:
     """Market context used as input for AI analysis."""
     symbol: str
     current_price: Optional[float] = None
     market_data: Optional[Dict[str, Any]] = None
-    timestamp: datetime = field(default_factory=datetime.now)
+    _timestamp: Optional[datetime] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self) -> None:
         self.symbol = self.symbol.upper().strip()
 
+    @property
+    def timestamp(self) -> datetime:
+        """Timestamp of the analysis, taken on first access (slots dataclass, so no cached_property)."""
+        if self._timestamp is None:
+            self._timestamp = datetime.now()
+        return self._timestamp
+
 
 @dataclass
 class AnalysisResponse:
@@ -53,104 +62,31 @@ class AnalysisResponse:
     content: Optional[Dict[str, Any]] = None
 
 
-def make_json_serializable(obj: Union[Dict, List, Any]) -> Union[Dict, List, Any]:
-    """Recursively convert non-serializable types (e.g., Timestamp) in dict/list to JSON-friendly formats."""
-    if isinstance(obj, dict):
-        return {k: make_json_serializable(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [make_json_serializable(item) for item in obj]
-    elif isinstance(obj, pd.Timestamp) or isinstance(obj, datetime):
+def _orjson_default(obj: Any) -> Any:
+    """orjson fallback: Timestamp/datetime subclasses -> ISO string, anything else -> str."""
+    if isinstance(obj, datetime):
         return obj.isoformat()
-    return obj
-
-
-def json_serializable_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
-    """Convert DataFrame to list of dicts with Timestamp converted to ISO string."""
-    def convert_value(v: Any) -> Any:
-        if isinstance(v, pd.Timestamp) or isinstance(v, datetime):
-            return v.isoformat()
-        return v
-
-    records = df.to_dict(orient='records')
-    for r in records:
-        for k, v in r.items():
-            r[k] = convert_value(v)
-    return records
-
-
-class TechnicalAnalyst:
-    """
-    AI Agent specialized in technical analysis.
-
-    Responsibilities:
-    - Compact raw data tables for prompts.
-    - Generate structured prompts with bull/neutral/bear scenarios.
-    - Call Gemini asynchronously and parse JSON responses into AnalysisResponse.
-    """
-    def __init__(self, apikey: str, model: str = "gemini-2.0-flash") -> None:
-        if not genai:
-            raise ImportError(
-                "google-generativeai not installed. Install with: "
-                "pip install google-generativeai"
-            )
-        self.apikey = apikey
-        self.model = model
-        genai.configure(api_key=apikey)
-        self.client = genai.GenerativeModel(model)
-
-    async def analyze(self, context: MarketContext) -> AnalysisResponse:
-        """
-        Perform technical analysis based on context's market_data.
-
-        Steps:
-        - Compact data.
-        - Create prompt.
-        - Call AI asynchronously.
-        - Parse response.
-        """
-        data_for_ai = self._compact_market_data(context)
-        prompt = self._create_prompt(data_for_ai)
-        ai_text = await self._call_ai_async(prompt)
-        return self._parse_response(ai_text)
+    return str(obj)
 
-    def _compact_market_data(self, context: MarketContext) -> Dict[str, Any]:
-        """Compress raw data tables for prompt embedding, ensuring brevity and JSON serializability."""
-        md = context.market_data or {}
-        ts = md.get("timestamp", datetime.now().strftime("%Y-%m-%d"))
 
-        # Raw data tables (compact to tail(100) and make JSON serializable)
-        price_history = md.get("price_history")
-        price_history_compact = (
-            json_serializable_records(price_history.tail(200))
-            if isinstance(price_history, pd.DataFrame) and not price_history.empty
-            else []
-        )
+# Prompt JSON: compact (no indent, the model does not need pretty-printing and whitespace costs tokens);
+# numpy scalars/arrays and non-str keys handled natively in C
+PROMPT_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
 
-        comprehensive_analysis = make_json_serializable(md.get("comprehensive_analysis", {}))  # Recursive convert for safety
-
-        index_history = md.get("index_history")
-        index_history_compact = (
-            json_serializable_records(index_history.tail(200))
-            if isinstance(index_history, pd.DataFrame) and not index_history.empty
-            else []
-        )
+# Sections of PriceAPI.get_comprehensive_analysis() the prompt actually uses; its own "timestamp"
+# duplicates the top-level one and "divergences" is an always-empty placeholder
+COMPREHENSIVE_KEYS = (
+    "technical_summary", "moving_averages", "volume_analysis",
+    "support_resistance", "fibonacci", "patterns", "data_quality",
+)
 
-        return {
-            "symbol": context.symbol,
-            "latest_price": context.current_price,
-            "timestamp": ts,
-            "price_history": price_history_compact,  # Raw enhanced price history (tail 100, serialized)
-            "comprehensive_analysis": comprehensive_analysis,  # Raw comprehensive dict (serialized)
-            "index_history": index_history_compact,  # Raw index history (tail 100, serialized)
-        }
+# 60 sessions cover the MA20/MA50 context; longer-term levels already come from comprehensive_analysis
+PRICE_HISTORY_ROWS = 60
+INDEX_HISTORY_ROWS = 200
 
-    def _create_prompt(self, data: Dict) -> str:
-        """Tạo prompt phân tích chuyên sâu theo VSA và SEBA để đưa ra hành động tối ưu."""
-        symbol = data.get("symbol", "N/A")
-        latest_price = data.get("latest_price", "N/A")
-        data_json = json.dumps(data, ensure_ascii=False, indent=2)
 
-        prompt_template = f"""
+# Prompt template (str.format: {symbol}, {latest_price}, {data_json}; literal braces doubled)
+PROMPT_TEMPLATE = """
         Bạn là một chuyên gia phân tích kỹ thuật cấp cao tại quỹ đầu tư lớn nhất Việt Nam, với hơn 20 năm kinh nghiệm phân tích cổ phiếu HOSE. Bạn chuyên sâu về VSA (Volume Spread Analysis) và phương pháp SEBA (Supply, Effort, Background, Action), tập trung vào việc phân tích sự mất cân bằng cung-cầu qua volume, spread, closing price, và price action để xác định hành động tối ưu.
 
         **Dữ liệu đầu vào:**
@@ -240,18 +176,155 @@ class TechnicalAnalyst:
         - Đưa ra nhận định chuyên môn cao: Tập trung vào hành động giá kết hợp khối lượng để dự đoán xu hướng ngắn hạn (1-3 tháng).
         - JSON phải hợp lệ, đầy đủ, và chỉ dựa trên dữ liệu cung cấp (giá ở nghìn VND).
         """
-        return prompt_template
+
+
+def _df_to_json_fragment(df: pd.DataFrame) -> orjson.Fragment:
+    """Serialize a DataFrame to a JSON records array in C (pandas to_json, ISO dates) as a pre-serialized orjson fragment."""
+    return orjson.Fragment(df.to_json(orient="records", date_format="iso", force_ascii=False))
+
+
+# DataFrames are unhashable, so WeakKeyDictionary cannot key on them: key on id() and keep a weakref
+# whose callback drops the entry once the frame is garbage-collected (so a reused id never hits)
+_TAIL_FRAGMENT_CACHE: Dict[Tuple[int, int], Tuple[weakref.ref, orjson.Fragment]] = {}
+
+
+def _cached_tail_fragment(df: pd.DataFrame, n: int = 200) -> orjson.Fragment:
+    """
+    JSON fragment of df.tail(n), computed once per DataFrame object.
+
+    The same market_data frames are reused across analyze() calls (retries, several agents on one
+    loaded dataset), so the tail + to_json work is done only the first time. Frames are treated as
+    read-only once loaded; an in-place mutation would not be seen.
+    """
+    key = (id(df), n)
+    entry = _TAIL_FRAGMENT_CACHE.get(key)
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+    fragment = _df_to_json_fragment(df.tail(n))
+    ref = weakref.ref(df, lambda _, key=key: _TAIL_FRAGMENT_CACHE.pop(key, None))
+    _TAIL_FRAGMENT_CACHE[key] = (ref, fragment)
+    return fragment
+
+
+class TechnicalAnalyst:
+    """
+    AI Agent specialized in technical analysis.
+
+    Responsibilities:
+    - Compact raw data tables for prompts.
+    - Generate structured prompts with bull/neutral/bear scenarios.
+    - Call Gemini asynchronously and parse JSON responses into AnalysisResponse.
+    """
+    def __init__(self, apikey: str, model: str = "gemini-2.0-flash") -> None:
+        if not import_genai():
+            raise ImportError(
+                "google-generativeai not installed. Install with: "
+                "pip install google-generativeai"
+            )
+        self.apikey = apikey
+        self.model = model
+        self.client = get_model(apikey, model)
+
+    async def analyze(
+        self, context: MarketContext, on_chunk: Optional[Callable[[str], None]] = None
+    ) -> AnalysisResponse:
+        """
+        Perform technical analysis based on context's market_data.
+
+        Steps:
+        - Compact data.
+        - Create prompt.
+        - Call AI asynchronously (streamed to on_chunk when given).
+        - Parse response.
+        """
+        if on_chunk is not None:
+            parts: List[str] = []
+            async for piece in self.analyze_stream(context):
+                parts.append(piece)
+                on_chunk(piece)
+            return self._parse_response("".join(parts))
+
+        data_for_ai = self._compact_market_data(context)
+        prompt = self._create_prompt(data_for_ai)
+        ai_text = await self._call_ai_async(prompt)
+        return self._parse_response(ai_text)
+
+    async def analyze_stream(self, context: MarketContext) -> AsyncIterator[str]:
+        """Same prompt as analyze(), but yields raw text chunks as Gemini streams them."""
+        data_for_ai = self._compact_market_data(context)
+        prompt = self._create_prompt(data_for_ai)
+        async for piece in self._stream_ai_async(prompt):
+            yield piece
+
+    def _compact_market_data(self, context: MarketContext) -> Dict[str, Any]:
+        """Compress raw data tables for prompt embedding, ensuring brevity and JSON serializability."""
+        md = context.market_data or {}
+        # Fallback evaluated only when needed, from the context's single (lazy) timestamp
+        ts = md.get("timestamp") or context.timestamp.strftime("%Y-%m-%d")
+
+        # Raw data tables (compact to the last rows and make JSON serializable)
+        price_history = md.get("price_history")
+        price_history_compact = (
+            _cached_tail_fragment(price_history, PRICE_HISTORY_ROWS)
+            if isinstance(price_history, pd.DataFrame) and not price_history.empty
+            else []
+        )
+
+        # Keep only the sections the prompt uses; Timestamps etc. handled by orjson default in _create_prompt
+        comprehensive_raw = md.get("comprehensive_analysis") or {}
+        comprehensive_analysis = {k: comprehensive_raw[k] for k in COMPREHENSIVE_KEYS if k in comprehensive_raw}
+
+        index_history = md.get("index_history")
+        index_history_compact = (
+            _cached_tail_fragment(index_history, INDEX_HISTORY_ROWS)
+            if isinstance(index_history, pd.DataFrame) and not index_history.empty
+            else []
+        )
+
+        return {
+            "symbol": context.symbol,
+            "latest_price": context.current_price,
+            "timestamp": ts,
+            "price_history": price_history_compact,  # Raw enhanced price history (last 60 rows, serialized)
+            "comprehensive_analysis": comprehensive_analysis,  # Pruned comprehensive dict
+            "index_history": index_history_compact,  # Raw index history (tail 200, serialized)
+        }
+
+    def _create_prompt(self, data: Dict) -> str:
+        """Tạo prompt phân tích chuyên sâu theo VSA và SEBA để đưa ra hành động tối ưu."""
+        symbol = data.get("symbol", "N/A")
+        latest_price = data.get("latest_price", "N/A")
+        # orjson chèn nguyên văn các bảng đã serialize sẵn (Fragment), không encode lại
+        data_json = orjson.dumps(data, default=_orjson_default, option=PROMPT_JSON_OPTIONS).decode()
+
+        return PROMPT_TEMPLATE.format(symbol=symbol, latest_price=latest_price, data_json=data_json)
 
 
 
     async def _call_ai_async(self, prompt: str) -> str:
         """Asynchronous call to Gemini API, expecting JSON text."""
+        async def _request() -> str:
+            try:
+                # Sync client in a worker thread: the shared model is used from several event loops
+                # (per-thread page loops, the background loop), which the SDK's grpc.aio client cannot serve
+                resp = await asyncio.to_thread(self.client.generate_content, prompt, generation_config={"temperature": 0.7})
+                return resp.text
+            except Exception as e:
+                raise RuntimeError(f"AI API call failed: {e}") from e
+
+        # Identical prompt within the TTL (refresh / retry) -> cached text, no Gemini call
+        return await cached_response(self.model, prompt, _request)
+
+    async def _stream_ai_async(self, prompt: str) -> AsyncIterator[str]:
+        """Streaming call to Gemini API (stream=True), yielding text chunks."""
+        def _chunks():
+            stream = self.client.generate_content(prompt, generation_config={"temperature": 0.7}, stream=True)
+            return (chunk.text for chunk in stream)
+
         try:
-            loop = asyncio.get_event_loop()
-            resp = await loop.run_in_executor(
-                None, lambda: self.client.generate_content(prompt, generation_config={"temperature": 0.7})
-            )
-            return resp.text
+            # Cache hit (same prompt within the TTL) -> replay the cached text, no Gemini call
+            async for piece in cached_stream(self.model, prompt, lambda: aiter_in_thread(_chunks)):
+                yield piece
         except Exception as e:
             raise RuntimeError(f"AI API call failed: {e}") from e
 
@@ -262,7 +335,12 @@ class TechnicalAnalyst:
             end = response_text.rfind("}") + 1
             if start == -1 or end <= start:
                 raise ValueError("No JSON found in response.")
-            data = json.loads(response_text[start:end])
+            try:
+                # Fast path: Gemini usually returns the object alone (possibly inside a code fence)
+                data = orjson.loads(response_text[start:end])
+            except orjson.JSONDecodeError:
+                # Trailing prose containing "}" etc.: raw_decode stops at the brace matching the first "{"
+                data, _ = _JSON_DECODER.raw_decode(response_text, start)
             strat = data.get("strategy_recommendation", {})
             action = strat.get("action", "NA")
             reliability = data.get("investment_scores", {}).get("reliability_score", 50)
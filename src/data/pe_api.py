@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional, Union
+from typing import List, Dict, Optional, Tuple, Union
 import numpy as np
 import scipy.stats as stats
 import pandas as pd
 from vnstock import Quote, Finance
 
+# Các mức phân vị PE dùng cho thống kê phân phối
+PERCENTILE_LEVELS = [25, 30, 35, 40, 45, 50, 60, 65, 70, 75, 80, 85, 90, 95, 99]
+
 class DataProcessor:
     @staticmethod
     def add_year_quarter(df: pd.DataFrame, time_col="time") -> pd.DataFrame:
@@ -80,13 +84,18 @@ class DataProcessor:
         }
 
         # Giá trị PEtrailing hiện tại (cuối cùng theo time)
-        percentiles = [25,30,35, 40,45, 50, 60,65,70,75, 80,85, 90, 95, 99]
-        for p in percentiles:
-            stats_dict[f"percentile_{p}"] = np.percentile(pe_values, p).round(1)
+        # Tính tất cả phân vị trong một lần gọi np.percentile (một lần sort thay vì mỗi mức một lần)
+        pe_percentiles = np.percentile(pe_values.to_numpy(), PERCENTILE_LEVELS).round(1)
+        for p, value in zip(PERCENTILE_LEVELS, pe_percentiles):
+            stats_dict[f"percentile_{p}"] = value
 
         # Các phân vị quan trọng
         if not np.isnan(current_pe):
-            current_percentile = stats.percentileofscore(pe_values, current_pe)
+            # Tương đương stats.percentileofscore(kind='rank') nhưng đếm trực tiếp trên mảng numpy
+            pe_arr = pe_values.to_numpy()
+            left = np.count_nonzero(pe_arr < current_pe)
+            right = np.count_nonzero(pe_arr <= current_pe)
+            current_percentile = (left + right + (1 if right > left else 0)) * 50.0 / len(pe_arr)
             stats_dict["current_percentile"] = round(current_percentile, 1)
         else:
             stats_dict["current_percentile"] = np.nan
@@ -123,7 +132,8 @@ class DataProcessor:
         # Đảo ngược y để trend tính từ cũ đến mới
         if len(pe_values) >= 200:
             # So sánh với MA20
-            ma200 = pe_values.rolling(window=200).mean().iloc[199]  # MA đầu tiên được tính ở index 19
+            # Chỉ cần MA200 đầu tiên (= trung bình 200 giá trị đầu): lấy slice thay vì tính rolling cả chuỗi
+            ma200 = pe_values.iloc[:200].mean()
             stats_dict["ma200"] = round(ma200, 1)
 
             if not np.isnan(current_pe) and not np.isnan(ma200):
@@ -153,9 +163,21 @@ class PEAPI:
         df = raw.droplevel(0, axis=1)
         return df.sort_values(["Năm","Kỳ"], ascending=[False, False])
 
+    def fetch_price_ratio(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Tải song song lịch sử giá và bảng ratio (2 request mạng độc lập, blocking) -> (price_df, ratio_df)"""
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            price_future = pool.submit(self.get_price_history)
+            ratio_future = pool.submit(self.get_ratio_data)
+            return price_future.result(), ratio_future.result()
+
     def compute_pe_trailing(self, price_df=None, ratio_df=None) -> pd.DataFrame:
-        price_df = price_df or self.get_price_history()
-        ratio_df = ratio_df or self.get_ratio_data()
+        if price_df is None and ratio_df is None:
+            price_df, ratio_df = self.fetch_price_ratio()
+        # `df or ...` raise ValueError với DataFrame -> so sánh với None để dùng lại frame đã tải
+        if price_df is None:
+            price_df = self.get_price_history()
+        if ratio_df is None:
+            ratio_df = self.get_ratio_data()
         return DataProcessor.merge_price_ratio(price_df, ratio_df)
 
     def calculate_pe_distribution_stats(self,df=None):
@@ -104,8 +104,9 @@ class PriceAPI:
         end: Optional[str] = None,
         interval: str = "1D",
     ) -> Dict[str, Any]:
-        df = self.get_enhanced_price_history(start=start, end=end, interval=interval)
+        # Một lần datetime.now() cho cả ngày kết thúc tải dữ liệu và timestamp của kết quả
         ts = datetime.now().strftime("%Y-%m-%d")
+        df = self.get_enhanced_price_history(start=start, end=end or ts, interval=interval)
 
         if df.empty:
             return {
@@ -139,8 +140,11 @@ class PriceAPI:
         latest_volume = int(volume.iloc[-1])
 
         # Moving averages
+        # Chỉ cần giá trị MA cuối: lấy trung bình n phần tử cuối thay vì rolling cả chuỗi
+        # (len < n -> NaN như rolling(n))
         def ma(series, n):
-            return float(pd.Series(series).rolling(n).mean().iloc[-1])
+            values = np.asarray(series, dtype="float64")
+            return float(values[-n:].mean()) if len(values) >= n else float("nan")
 
         ma5 = ma(close, 5)
         ma20 = ma(close, 20)
@@ -151,7 +155,7 @@ class PriceAPI:
         p_vs_ma50 = round((latest_close / ma50 - 1) * 100, 2) if ma50 else None
 
         # Volume analysis
-        vol_ma20 = float(pd.Series(volume).rolling(20).mean().iloc[-1])
+        vol_ma20 = ma(volume, 20)
         vol_ratio = round(latest_volume / vol_ma20, 2) if vol_ma20 else None
         obv = pd.Series(np.sign(close.diff().fillna(0)) * volume).cumsum()
         obv_latest = float(obv.iloc[-1])
@@ -164,8 +168,8 @@ class PriceAPI:
         pivot = round((2*h + l + c) / 4, 2)
         r1 = round(2 * pivot - l, 2); s1 = round(2 * pivot - h, 2)
         r2 = round(pivot + (h - l), 2); s2 = round(pivot - (h - l), 2)
-        dyn_support = float(low.rolling(20).min().iloc[-1])
-        dyn_resistance = float(high.rolling(20).max().iloc[-1])
+        dyn_support = float(low.tail(20).min()) if len(low) >= 20 else float("nan")
+        dyn_resistance = float(high.tail(20).max()) if len(high) >= 20 else float("nan")
 
         # Fibonacci (50 phiên)
         sw = close.tail(50)
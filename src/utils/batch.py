@@ -0,0 +1,69 @@
+"""
+Batch analysis helpers for Agents Stock 2.0.
+"""
+import asyncio
+from typing import Any, AsyncIterator, Iterable, List, Tuple, Union
+
+
+class BatchAnalysisMixin:
+    """
+    Phân tích nhiều mã đồng thời cho các agent có `async def analyze(context)`.
+
+    Số lời gọi analyze() chạy cùng lúc bị giới hạn bởi max_concurrency (Semaphore);
+    lỗi của từng mã được trả về dạng exception thay vì làm hỏng cả lô.
+    """
+
+    async def analyze_many(self, contexts: Iterable[Any], max_concurrency: int = 8) -> List[Union[Any, BaseException]]:
+        """
+        Phân tích nhiều mã đồng thời.
+
+        Args:
+            contexts: Các MarketContext cần phân tích
+            max_concurrency: Số mã phân tích cùng lúc tối đa
+
+        Returns:
+            Kết quả theo thứ tự đầu vào; mã lỗi có giá trị là exception
+        """
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _one(context: Any) -> Any:
+            async with sem:
+                return await self.analyze(context)
+
+        return await asyncio.gather(*(_one(c) for c in contexts), return_exceptions=True)
+
+    async def analyze_iter(
+        self, contexts: Iterable[Any], max_concurrency: int = 8
+    ) -> AsyncIterator[Tuple[Any, Union[Any, BaseException]]]:
+        """
+        Giống analyze_many() nhưng yield (context, kết quả) ngay khi từng mã xong.
+
+        Kết quả đã yield không được giữ lại nên bộ nhớ không tăng theo số mã; consumer
+        dừng sớm thì các mã còn lại bị hủy.
+
+        Args:
+            contexts: Các MarketContext cần phân tích
+            max_concurrency: Số mã phân tích cùng lúc tối đa
+
+        Yields:
+            (context, kết quả hoặc exception) theo thứ tự hoàn thành
+        """
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _one(context: Any):
+            async with sem:
+                try:
+                    return context, await self.analyze(context)
+                except Exception as e:
+                    return context, e
+
+        pending = {asyncio.ensure_future(_one(c)) for c in contexts}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Task đã xong bị bỏ sau khi yield (không giữ list toàn bộ kết quả)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
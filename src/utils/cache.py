@@ -0,0 +1,131 @@
+"""
+File cache helpers for Agents Stock 2.0.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple
+
+import orjson
+import pandas as pd
+
+
+def _json_default(obj: Any) -> Any:
+    # numpy scalar -> Python scalar (NaN giữ là float), mảng -> list, datetime/Timestamp -> ISO
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return str(obj)
+
+
+def dumps_json(value: Any) -> bytes:
+    """
+    Serialize JSON cho cache đĩa, giữ nguyên NaN/Infinity.
+
+    orjson ghi NaN thành null nên sau khi đọc lại các thống kê NaN thành None
+    (float(None) -> TypeError); json stdlib ghi literal NaN và đọc lại đúng float('nan').
+    """
+    return json.dumps(value, default=_json_default, ensure_ascii=False, allow_nan=True).encode("utf-8")
+
+
+def loads_json(data: bytes) -> Any:
+    """Đọc lại dữ liệu ghi bởi dumps_json (chấp nhận literal NaN/Infinity)."""
+    return json.loads(data)
+
+
+class FileCache:
+    """
+    Cache TTL hai tầng (bộ nhớ + đĩa) cho dữ liệu lấy từ API, khóa theo (symbol, endpoint, kwargs).
+
+    DataFrame được lưu dạng parquet, các giá trị khác (dict/list) dạng JSON (giữ NaN) tại
+    `{cache_dir}/{symbol}/{endpoint}[-{md5(kwargs)}].{parquet|json}`. Thời điểm ghi lấy từ mtime của file.
+
+    Args:
+        ttl_seconds: Thời gian sống của một entry (giây)
+        cache_dir: Thư mục gốc của cache trên đĩa
+    """
+
+    def __init__(self, ttl_seconds: int = 86400, cache_dir: str = ".cache") -> None:
+        self.ttl_seconds = ttl_seconds
+        self.cache_dir = Path(cache_dir)
+        self._memory: Dict[Path, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _base_path(self, symbol: str, endpoint: str, kwargs: Dict[str, Any]) -> Path:
+        name = endpoint
+        if kwargs:
+            digest = hashlib.md5(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS)).hexdigest()
+            name = f"{endpoint}-{digest}"
+        return self.cache_dir / symbol.upper() / name
+
+    def _is_fresh(self, written_at: float) -> bool:
+        return time.time() - written_at < self.ttl_seconds
+
+    def _read_disk(self, base: Path) -> Tuple[bool, float, Any]:
+        for suffix, reader in ((".parquet", pd.read_parquet), (".json", lambda p: loads_json(p.read_bytes()))):
+            path = base.with_suffix(suffix)
+            try:
+                written_at = path.stat().st_mtime
+                if self._is_fresh(written_at):
+                    return True, written_at, reader(path)
+            except Exception:
+                continue
+        return False, 0.0, None
+
+    def _write_disk(self, base: Path, value: Any) -> None:
+        try:
+            base.parent.mkdir(parents=True, exist_ok=True)
+            if isinstance(value, pd.DataFrame):
+                path = base.with_suffix(".parquet")
+                tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                value.to_parquet(tmp)
+            else:
+                path = base.with_suffix(".json")
+                tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                tmp.write_bytes(dumps_json(value))
+            # Ghi file tạm rồi os.replace để tiến trình khác không đọc phải file ghi dở
+            os.replace(tmp, path)
+        except Exception:
+            # Cache đĩa chỉ là tối ưu (vd. thiếu pyarrow, dữ liệu không serialize được) -> bỏ qua
+            pass
+
+    def get_or_compute(self, symbol: str, endpoint: str, compute: Callable[[], Any], **kwargs: Any) -> Any:
+        """
+        Trả về giá trị đã cache nếu còn hạn, ngược lại gọi compute() rồi lưu lại.
+
+        Args:
+            symbol: Mã cổ phiếu
+            endpoint: Tên dữ liệu (vd. "income", "balance", "pe_trailing")
+            compute: Hàm lấy dữ liệu khi cache miss
+            **kwargs: Tham số của lần gọi, được băm MD5 vào khóa cache
+
+        Returns:
+            Giá trị từ cache hoặc kết quả của compute()
+        """
+        base = self._base_path(symbol, endpoint, kwargs)
+        with self._lock:
+            entry = self._memory.get(base)
+        if entry is not None and self._is_fresh(entry[0]):
+            return entry[1]
+
+        found, written_at, value = self._read_disk(base)
+        if not found:
+            value = compute()
+            written_at = time.time()
+            # Không cache kết quả rỗng (thường là lỗi tạm thời từ API)
+            if isinstance(value, pd.DataFrame) and value.empty:
+                return value
+            self._write_disk(base, value)
+        with self._lock:
+            self._memory[base] = (written_at, value)
+        return value
+
+
+# Cache dùng chung cho các agent: báo cáo tài chính thay đổi theo quý -> TTL 1 ngày;
+# dữ liệu gắn với giá hằng ngày (PE trailing) -> TTL 1 giờ
+api_cache = FileCache(ttl_seconds=86400)
+price_cache = FileCache(ttl_seconds=3600)
@@ -1,11 +1,12 @@
 """
 Configuration management for Agents Stock 2.0.
 """
-import json
 from pathlib import Path
 from typing import Dict, Any
 from functools import lru_cache
 
+import orjson
+
 @lru_cache(maxsize=1)
 def load_config(config_path: Path) -> Dict[str, Any]:
     """
@@ -18,7 +19,6 @@ def load_config(config_path: Path) -> Dict[str, Any]:
         Dict containing configuration settings
     """
     try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return orjson.loads(Path(config_path).read_bytes())
     except Exception as e:
         raise RuntimeError(f"Failed to load config from {config_path}: {e}")
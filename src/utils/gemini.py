@@ -0,0 +1,186 @@
+"""
+Gemini client helpers for Agents Stock 2.0.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+# google.generativeai (kéo theo grpc/protobuf) được import lười ở lần khởi tạo agent đầu tiên
+_genai = None
+
+
+def import_genai() -> Optional[Any]:
+    """
+    Import google.generativeai khi cần lần đầu.
+
+    Returns:
+        Module google.generativeai, hoặc None nếu chưa cài
+    """
+    global _genai
+    if _genai is None:
+        try:
+            import google.generativeai as genai
+        except ImportError:
+            return None
+        _genai = genai
+    return _genai
+
+
+# genai.configure() ghi cấu hình global: khóa để configure + gắn client của từng key không xen nhau
+_configure_lock = threading.Lock()
+
+
+@lru_cache(maxsize=8)
+def get_model(api_key: str, model: str) -> Any:
+    """
+    GenerativeModel dùng chung cho mọi agent, tạo một lần cho mỗi cặp (api_key, model).
+
+    Các agent kỹ thuật / cơ bản / PE / tổng hợp cùng gọi vào đây nên chỉ configure
+    một lần và dùng lại cùng client (kết nối HTTP/gRPC) thay vì mỗi agent tạo một client.
+
+    Chỉ dùng API sync (generate_content, kể cả stream=True) trên model này, gọi qua
+    asyncio.to_thread: model được dùng chung giữa nhiều event loop (loop theo thread
+    của các trang, loop nền) còn client async (grpc.aio) của SDK gắn với một loop.
+
+    Args:
+        api_key: Gemini API key
+        model: Tên model (vd. "gemini-2.0-flash")
+
+    Returns:
+        genai.GenerativeModel
+
+    Raises:
+        ImportError: Nếu chưa cài google-generativeai
+    """
+    genai = import_genai()
+    if genai is None:
+        raise ImportError("google-generativeai not installed. Install with: pip install google-generativeai")
+    from google.generativeai import client as genai_client
+
+    with _configure_lock:
+        genai.configure(api_key=api_key)
+        generative_model = genai.GenerativeModel(model)
+        # GenerativeModel chỉ lấy client mặc định ở lần gọi đầu, tức theo key được configure
+        # gần nhất; gắn ngay client sync tạo với key này để các model cache theo key khác không dùng lẫn
+        generative_model._client = genai_client.get_default_generative_client()
+    return generative_model
+
+
+# Cache phản hồi Gemini trong tiến trình: prompt giống hệt trong RESPONSE_TTL giây (refresh, bấm lại,
+# chạy lại cùng mã) trả về text đã có, không gọi lại API. Khóa = blake2b(model + prompt).
+RESPONSE_TTL = 900
+RESPONSE_CACHE_SIZE = 512
+_response_cache: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+# Request đang chạy theo khóa: các lời gọi đồng thời cùng prompt chỉ gửi một request.
+# concurrent.futures.Future (không phải asyncio.Lock) vì người chờ có thể ở event loop khác.
+_inflight: Dict[bytes, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _response_key(model: str, prompt: str) -> bytes:
+    return hashlib.blake2b(f"{model}\0{prompt}".encode(), digest_size=16).digest()
+
+
+def _cache_lookup(key: bytes) -> Optional[str]:
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= RESPONSE_TTL:
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return entry[1]
+
+
+def _cache_store(key: bytes, text: str) -> None:
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic(), text)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+async def cached_response(model: str, prompt: str, request: Callable[[], Awaitable[str]]) -> str:
+    """
+    Trả về text đã cache cho (model, prompt) nếu còn hạn, ngược lại await request() và lưu kết quả.
+
+    Chỉ cache phản hồi thành công; exception từ request() được raise lại nguyên vẹn.
+
+    Args:
+        model: Tên model (một phần của khóa cache)
+        prompt: Prompt gửi Gemini
+        request: Coroutine function gọi API khi cache miss
+
+    Returns:
+        Text phản hồi của Gemini
+    """
+    key = _response_key(model, prompt)
+    while True:
+        text = _cache_lookup(key)
+        if text is not None:
+            return text
+        with _inflight_lock:
+            future = _inflight.get(key)
+            owner = future is None
+            if owner:
+                future = _inflight[key] = Future()
+        if owner:
+            break
+        # Chờ request của lời gọi trước (wrap_future chuyển kết quả về loop hiện tại);
+        # None nghĩa là lời gọi đó bị hủy -> vòng lại, lời gọi này có thể thành người gửi
+        # shield: hủy lời gọi đang chờ không được hủy luôn Future dùng chung của người gửi
+        text = await asyncio.shield(asyncio.wrap_future(future))
+        if text is not None:
+            return text
+
+    try:
+        text = await request()
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    except BaseException:
+        future.set_result(None)
+        raise
+    else:
+        _cache_store(key, text)
+        future.set_result(text)
+        return text
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+async def cached_stream(model: str, prompt: str, stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """
+    Bản streaming của cached_response, dùng chung cache (cùng khóa model + prompt).
+
+    Cache hit: phát lại toàn bộ text đã cache thành một đoạn (on_chunk vẫn nhận được nội dung).
+    Cache miss: yield từng đoạn của stream() và chỉ lưu khi stream kết thúc trọn vẹn
+    (lỗi hoặc consumer dừng sớm thì không lưu). Các stream đồng thời cùng prompt không được gộp.
+
+    Args:
+        model: Tên model (một phần của khóa cache)
+        prompt: Prompt gửi Gemini
+        stream: Hàm tạo async iterator các đoạn text khi cache miss
+
+    Yields:
+        Các đoạn text phản hồi
+    """
+    key = _response_key(model, prompt)
+    text = _cache_lookup(key)
+    if text is not None:
+        yield text
+        return
+
+    parts = []
+    async for piece in stream():
+        parts.append(piece)
+        yield piece
+    _cache_store(key, "".join(parts))
@@ -0,0 +1,49 @@
+"""
+Streaming helpers for Agents Stock 2.0.
+"""
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Callable, Iterable
+
+_STREAM_END = object()
+
+
+async def aiter_in_thread(make_iterable: Callable[[], Iterable[Any]]) -> AsyncIterator[Any]:
+    """
+    Duyệt một iterator đồng bộ (vd. generate_content(..., stream=True)) trong thread riêng
+    và trả từng phần tử về event loop qua asyncio.Queue, không chặn loop.
+
+    Args:
+        make_iterable: Hàm tạo iterable; được gọi trong worker thread
+
+    Yields:
+        Từng phần tử của iterable; exception trong thread được raise lại tại đây
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    # Consumer dừng sớm (break / bị hủy) -> báo thread ngừng đọc stream giữa hai phần tử
+    stop = threading.Event()
+
+    def _produce() -> None:
+        try:
+            for item in make_iterable():
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+    producer = loop.run_in_executor(None, _produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        await producer
@@ -7,19 +7,26 @@ import asyncio
 import json
 import os
 import re
+import tempfile
+import threading
+import time
 import traceback
+from datetime import datetime
+from pathlib import Path
 from typing import Any, Dict, List, Optional
 
+import numpy as np
+import orjson
 import pandas as pd
 import streamlit as st
-import plotly.graph_objects as go
-import plotly.express as px
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Local imports (fallback to same directory if needed)
-
-from src.data.price_api import PriceAPI  # Giả sử bạn có file price_api.py
+# plotly và PriceAPI được import lười trong hàm dựng figure / hàm load dữ liệu:
+# rerun trúng cache không phải import chúng
 
 from src.agents.technical_analyst import MarketContext, TechnicalAnalyst
+from src.utils.cache import dumps_json, loads_json
 
 
 # ==============================================================================
@@ -39,18 +46,34 @@ def get_api_key() -> Optional[str]:
     except (FileNotFoundError, json.JSONDecodeError):
         return None
 
+# nest_asyncio chỉ import một lần khi nạp module; mỗi loop chỉ patch một lần
+# (nest_asyncio đánh dấu loop đã patch bằng thuộc tính _nest_patched)
+try:
+    import nest_asyncio
+except ImportError:
+    nest_asyncio = None
+
+def _apply_nest_asyncio(loop: asyncio.AbstractEventLoop) -> None:
+    if nest_asyncio is not None and not getattr(loop, '_nest_patched', False):
+        nest_asyncio.apply(loop)
+
+# Loop riêng cho từng thread (Streamlit chạy mỗi phiên trên một script thread)
+_TLS = threading.local()
+
 # Đảm bảo event loop cho async
 def ensure_event_loop() -> asyncio.AbstractEventLoop:
+    # get_running_loop không đi qua nhánh deprecated của get_event_loop (Python 3.12+)
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            import nest_asyncio
-            nest_asyncio.apply()
-        return loop
+        loop = asyncio.get_running_loop()
     except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        loop = getattr(_TLS, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            _TLS.loop = loop
         return loop
+    _apply_nest_asyncio(loop)
+    return loop
 
 # Chạy coroutine async
 def run_async(coro) -> Any:
@@ -100,23 +123,26 @@ def extract_and_parse_ai_json(ai_response) -> Dict[str, Any]:
     
     return {}
 
+# Regex biên dịch sẵn một lần ở module
+_JSON_BLOCK_RE = re.compile(r'```json\s*\n(.*?)\n```', re.DOTALL)
+_CODE_FENCE_RE = re.compile(r'```(?:json)?')
+
 def parse_json_from_markdown(text: str) -> Dict[str, Any]:
     """
     Parse JSON từ markdown text có format ```json...```
     """
     try:
         # Tìm JSON trong markdown blocks
-        json_pattern = r'```json\s*\n(.*?)\n```'
-        match = re.search(json_pattern, text, re.DOTALL)
+        match = _JSON_BLOCK_RE.search(text)
         
         if match:
             json_str = match.group(1)
-            return json.loads(json_str)
+            return orjson.loads(json_str)
         
         # Fallback: thử parse toàn bộ text
         # Loại bỏ markdown formatting nếu có
-        cleaned_text = text.replace('```json', '').replace('```', '').strip()
-        return json.loads(cleaned_text)
+        cleaned_text = _CODE_FENCE_RE.sub('', text).strip()
+        return orjson.loads(cleaned_text)
         
     except (json.JSONDecodeError, AttributeError) as e:
         st.error(f"Lỗi parse JSON: {e}")
@@ -143,8 +169,25 @@ def show_colored_action(action: str):
         unsafe_allow_html=True
     )
 
-def show_confidence_gauge(confidence: float):
-    """Hiển thị confidence bằng gauge chart"""
+# ------------------------------------------------------------------------------
+# Figure được dựng trong các hàm build_*_fig có st.cache_data, trả về fig.to_plotly_json():
+# rerun với cùng input không phải tạo + validate lại graph object của Plotly.
+# ------------------------------------------------------------------------------
+
+def _price_df_signature(df: pd.DataFrame) -> tuple:
+    """Khóa cache cho price_df: hash nội dung mọi dòng (frame chỉ ~100 dòng nên rẻ).
+
+    Không dùng (số dòng, phiên cuối, giá cuối): caller luôn cắt 100 dòng nên hai mã cùng
+    ngày + cùng giá đóng cửa sẽ dùng nhầm biểu đồ của nhau.
+    """
+    if df.empty:
+        return (0,)
+    return (len(df), int(pd.util.hash_pandas_object(df, index=False).sum()))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def build_gauge_fig(confidence: float) -> dict:
+    import plotly.graph_objects as go
+
     fig = go.Figure(go.Indicator(
         mode = "gauge+number+delta",
         value = confidence,
@@ -167,33 +210,36 @@ def show_confidence_gauge(confidence: float):
         }
     ))
     fig.update_layout(height=300, margin=dict(l=20, r=20, t=40, b=20))
-    st.plotly_chart(fig, use_container_width=True)
+    return fig.to_plotly_json()
 
-def show_investment_scores(scores: dict):
-    """
-    Hiển thị investment scores bằng biểu đồ Radar và tính điểm trung bình.
-    """
-    if not scores:
-        st.warning("Không có dữ liệu điểm đầu tư")
+# True: dùng gauge Plotly đầy đủ; False: st.metric + thanh CSS (không mount Plotly.js)
+FEATURE_RICH_GAUGE = False
+
+_CONFIDENCE_BAR_HTML = (
+    "<div style='background:#e0e0e0;border-radius:4px;height:10px'>"
+    "<div style='width:{pct:.0f}%;background:darkblue;height:10px;border-radius:4px'></div></div>"
+)
+
+def show_confidence_gauge(confidence: float):
+    """Hiển thị confidence bằng st.metric + thanh tiến độ (hoặc gauge chart nếu bật FEATURE_RICH_GAUGE)"""
+    if FEATURE_RICH_GAUGE:
+        st.plotly_chart(build_gauge_fig(confidence), use_container_width=True)
         return
-    
-    labels = list(scores.keys())
-    values = [int(s) if isinstance(s, (int, float)) else 0 for s in scores.values()]
-    
-    # --- 1. Tính và hiển thị điểm trung bình ---
-    if values:
-        average_score = sum(values) / len(values)
-    else:
-        average_score = 0
-    
-    st.metric(label="Điểm trung bình", value=f"{average_score:.1f}/100")
+    st.metric("Độ tin cậy", f"{confidence:.1f}%", delta=f"{confidence - 50:+.1f}")
+    st.markdown(_CONFIDENCE_BAR_HTML.format(pct=min(max(confidence, 0.0), 100.0)), unsafe_allow_html=True)
 
-    # --- 2. Tạo biểu đồ Radar ---
+@st.cache_data(ttl=300, show_spinner=False)
+def build_scores_fig(labels: tuple, values: tuple) -> dict:
+    import plotly.graph_objects as go
+
+    # Mảng numpy: plotly>=6 gửi sang trình duyệt dạng typed array thay vì list số JSON
+    r = np.asarray(values + values[:1], dtype=np.float64)  # Lặp lại điểm đầu để khép kín biểu đồ
     fig = go.Figure()
 
     # Thêm trace Scatterpolar
     fig.add_trace(go.Scatterpolar(
-        r=values + [values[0]],  # Lặp lại điểm đầu để khép kín biểu đồ
+        r=r,
+        theta=list(labels + labels[:1]),
         fill='toself',  # Tô màu cho vùng bên trong
         name='Điểm số'
     ))
@@ -209,29 +255,89 @@ def show_investment_scores(scores: dict):
         height=450,
         showlegend=False # Ẩn chú thích (legend)
     )
+    return fig.to_plotly_json()
+
+def show_investment_scores(scores: dict):
+    """
+    Hiển thị investment scores bằng biểu đồ Radar và tính điểm trung bình.
+    """
+    if not scores:
+        st.warning("Không có dữ liệu điểm đầu tư")
+        return
     
-    st.plotly_chart(fig, use_container_width=True)
+    labels = list(scores.keys())
+    # Ép điểm số về mảng numpy (giá trị không phải số -> 0, NaN/inf -> 0)
+    values = np.fromiter((s if isinstance(s, (int, float)) else 0 for s in scores.values()), dtype=np.float64, count=len(scores))
+    values = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
     
-def show_price_chart(price_df: pd.DataFrame):
-    """Hiển thị biểu đồ giá với candlestick"""
+    # --- 1. Tính và hiển thị điểm trung bình ---
+    average_score = float(values.mean()) if values.size else 0.0
+    
+    st.metric(label="Điểm trung bình", value=f"{average_score:.1f}/100")
 
+    # --- 2. Biểu đồ Radar (figure được cache theo labels + values) ---
+    fig_dict = build_scores_fig(tuple(labels), tuple(values.tolist()))
+    st.plotly_chart(fig_dict, use_container_width=True)
     
+# Số cột volume tối đa gửi sang trình duyệt; nhiều hơn thì giảm mẫu bằng LTTB
+MAX_VOLUME_BARS = 500
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: chọn n_out điểm giữ hình dạng chuỗi (x, y).
+    Trả về chỉ số các điểm được giữ (luôn gồm điểm đầu và cuối).
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # n_out - 2 bucket trải đều trên các điểm 1..n-2
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        xs, ys = x[start:end], y[start:end]
+        # Diện tích tam giác (điểm đã chọn, ứng viên, trung bình bucket kế tiếp)
+        area = np.abs((x[a] - avg_x) * (ys - y[a]) - (x[a] - xs) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+@st.cache_data(ttl=300, show_spinner=False, hash_funcs={pd.DataFrame: _price_df_signature})
+def build_price_fig(price_df: pd.DataFrame) -> dict:
+    import plotly.graph_objects as go
+
     fig = go.Figure()
     
+    # Truyền mảng numpy float64 liền bộ nhớ (không phải Series) để plotly>=6 mã hóa typed array
+    def as_f64(col: str) -> np.ndarray:
+        return np.ascontiguousarray(price_df[col].to_numpy(dtype=np.float64))
+
+    # Trục thời gian dạng datetime64 (kết hợp xaxis type='date', plotly không phải parse lại chuỗi ngày)
+    time_values = pd.to_datetime(price_df['time']).to_numpy(dtype='datetime64[ns]')
+
     # Candlestick chart
     fig.add_trace(go.Candlestick(
-        x=price_df['time'],
-        open=price_df['open'],
-        high=price_df['high'],
-        low=price_df['low'],
-        close=price_df['close'],
+        x=time_values,
+        open=as_f64('open'),
+        high=as_f64('high'),
+        low=as_f64('low'),
+        close=as_f64('close'),
         name='Price'
     ))
     
-    # Volume subplot
+    # Volume subplot (giảm mẫu bằng LTTB khi quá nhiều cột)
+    vol_time, vol_values = time_values, as_f64('volume')
+    if len(price_df) > MAX_VOLUME_BARS:
+        keep = lttb_indices(time_values.astype(np.int64).astype(np.float64), vol_values, MAX_VOLUME_BARS)
+        vol_time, vol_values = vol_time[keep], vol_values[keep]
     fig.add_trace(go.Bar(
-        x=price_df['time'],
-        y=price_df['volume'],
+        x=vol_time,
+        y=vol_values,
         name='Volume',
         yaxis='y2',
         opacity=0.3
@@ -240,14 +346,22 @@ def show_price_chart(price_df: pd.DataFrame):
     # Layout với 2 y-axis
     fig.update_layout(
         title="Biểu đồ giá và khối lượng",
+        xaxis=dict(type="date"),
         yaxis=dict(title="Giá", side="left"),
         yaxis2=dict(title="Khối lượng", side="right", overlaying="y"),
         
         height=500,
         margin=dict(l=20, r=20, t=40, b=20)
     )
-    
-    st.plotly_chart(fig, use_container_width=True)
+    return fig.to_plotly_json()
+
+def show_price_chart(price_df: pd.DataFrame):
+    """Hiển thị biểu đồ giá với candlestick"""
+    st.plotly_chart(build_price_fig(price_df), use_container_width=True)
+
+# Các trường đọc từ mỗi scenario và giá trị mặc định tương ứng
+SCENARIO_FIELDS = ('target_price', 'probability', 'drivers')
+SCENARIO_FIELD_DEFAULTS = ('N/A', 'N/A', ())
 
 def show_scenarios_table(scenarios: dict):
     """Hiển thị scenarios dạng bảng"""
@@ -255,25 +369,29 @@ def show_scenarios_table(scenarios: dict):
         st.warning("Không có scenarios")
         return
     
-    # Convert nested dict to DataFrame
-    scenario_data = []
+    # Convert nested dict to DataFrame: dựng theo cột (SoA) trong một lượt duyệt
+    names, targets, probs, drivers, descriptions = [], [], [], [], []
     for scenario_name, scenario_info in scenarios.items():
         if isinstance(scenario_info, dict):
-            scenario_data.append({
-                "Scenario": scenario_name.title(),
-                "Target Price": scenario_info.get('target_price', 'N/A'),
-                "Probability": scenario_info.get('probability', 'N/A'),
-                "Key Drivers": ', '.join(scenario_info.get('drivers', [])) if scenario_info.get('drivers') else 'N/A'
-            })
+            # Một lần get cho mỗi khóa, mặc định lấy từ SCENARIO_FIELD_DEFAULTS
+            target, prob, key_drivers = map(scenario_info.get, SCENARIO_FIELDS, SCENARIO_FIELD_DEFAULTS)
+            names.append(scenario_name.title())
+            targets.append(target)
+            probs.append(prob)
+            drivers.append(', '.join(key_drivers or ()) or 'N/A')
+            descriptions.append(None)
         else:
-            scenario_data.append({
-                "Scenario": scenario_name,
-                "Description": str(scenario_info)
-            })
-    
-    if scenario_data:
-        df_scenarios = pd.DataFrame(scenario_data)
-        st.table(df_scenarios)
+            names.append(scenario_name)
+            targets.append(None)
+            probs.append(None)
+            drivers.append(None)
+            descriptions.append(str(scenario_info))
+    
+    if names:
+        columns = {"Scenario": names, "Target Price": targets, "Probability": probs, "Key Drivers": drivers, "Description": descriptions}
+        # Bỏ các cột không có giá trị nào (vd. Description khi mọi scenario đều là dict)
+        df_scenarios = pd.DataFrame({k: v for k, v in columns.items() if any(x is not None for x in v)})
+        st.dataframe(df_scenarios, use_container_width=True, hide_index=True)
     else:
         st.warning("Không có scenarios hợp lệ")
 
@@ -297,7 +415,9 @@ def render_ai_dashboard(ai_json: dict, price_df: pd.DataFrame = None):
     info_col1, info_col2 = st.columns([65, 35])
     
     with info_col1:
-        show_price_chart(price_history.tail(100))
+        # 100 nến gần nhất ở độ phân giải gốc; dùng price_df được truyền vào thay vì biến global
+        source_df = price_df if isinstance(price_df, pd.DataFrame) else price_history
+        show_price_chart(source_df.iloc[-100:])
     with info_col2:
         st.subheader("📊 Điểm Đánh Giá Đầu Tư")
         scores = ai_json.get('investment_scores', {})
@@ -416,36 +536,110 @@ def render_ai_dashboard(ai_json: dict, price_df: pd.DataFrame = None):
 
 
 
+@st.fragment
+def render_dashboard_fragment(ai_json: dict, price_df: pd.DataFrame = None):
+    """Dashboard trong fragment: tương tác bên trong chỉ rerun phần này, không chạy lại cả trang"""
+    render_ai_dashboard(ai_json, price_df)
+
 # ==============================================================================
 # DATA LOADING FUNCTIONS
 # ==============================================================================
 
-# Cache dữ liệu riêng biệt cho từng phần (tránh recursion error)
-@st.cache_data(ttl=300)
+# Thư mục cache trên đĩa cho dữ liệu giá (dùng chung giữa các session / worker)
+DISK_CACHE_DIR = Path(tempfile.gettempdir()) / "agents_stock_cache"
+DISK_CACHE_TTL = 300  # giây
+
+def new_price_api(symbol: str):
+    """PriceAPI (client vnstock) mới cho mỗi lần tải: không dùng chung instance giữa các session/thread."""
+    from src.data.price_api import PriceAPI
+
+    return PriceAPI(symbol=symbol, source='VCI')
+
+def _disk_cache_path(symbol: str, name: str, suffix: str) -> Path:
+    safe_symbol = re.sub(r'\W', '_', symbol)
+    return DISK_CACHE_DIR / f"{safe_symbol}_{name}{suffix}"
+
+def _is_fresh(path: Path) -> bool:
+    try:
+        return time.time() - path.stat().st_mtime < DISK_CACHE_TTL
+    except OSError:
+        return False
+
+def _atomic_write(path: Path, write) -> None:
+    """Ghi ra file tạm rồi os.replace để session khác không đọc phải file ghi dở."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        write(tmp)
+        os.replace(tmp, path)
+    except Exception:
+        # Cache đĩa chỉ là tối ưu (vd. thiếu pyarrow, đĩa read-only) -> bỏ qua
+        pass
+
+def _load_frame(symbol: str, name: str, fetch) -> pd.DataFrame:
+    """DataFrame qua tầng cache parquet: trúng cache là đọc Arrow trực tiếp, không unpickle."""
+    path = _disk_cache_path(symbol, name, ".parquet")
+    if _is_fresh(path):
+        try:
+            return pd.read_parquet(path)
+        except Exception:
+            pass
+    df = fetch()
+    if isinstance(df, pd.DataFrame) and not df.empty:
+        _atomic_write(path, lambda tmp: df.to_parquet(tmp, index=False))
+    return df
+
 def load_price_history(symbol: str) -> pd.DataFrame:
-    api = PriceAPI(symbol=symbol, source='VCI')
-    return api.get_enhanced_price_history()
+    return _load_frame(symbol, "price", lambda: new_price_api(symbol).get_enhanced_price_history())
 
-@st.cache_data(ttl=300)
 def load_comprehensive(symbol: str) -> Dict[str, Any]:
-    api = PriceAPI(symbol=symbol, source='VCI')
-    return api.get_comprehensive_analysis()
+    path = _disk_cache_path(symbol, "comprehensive", ".json")
+    if _is_fresh(path):
+        try:
+            return loads_json(path.read_bytes())
+        except Exception:
+            pass
+    result = new_price_api(symbol).get_comprehensive_analysis()
+    # dumps_json giữ NaN (orjson ghi null -> float(None) lỗi khi đọc lại completeness_score...)
+    _atomic_write(path, lambda tmp: tmp.write_bytes(dumps_json(result)))
+    return result
 
-@st.cache_data(ttl=300)
 def load_index_history(symbol: str) -> pd.DataFrame:
-    api = PriceAPI(symbol=symbol, source='VCI')
-    return api.get_index_history()
+    return _load_frame(symbol, "index", lambda: new_price_api(symbol).get_index_history())
 
-# Hàm tổng hợp không cache (gọi các hàm cache trên)
+async def to_thread_with_ctx(func, *args) -> Any:
+    """Chạy hàm blocking trong thread riêng, giữ ScriptRunContext để st.* hoạt động bình thường."""
+    ctx = get_script_run_ctx()
+
+    def _call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+
+    return await asyncio.to_thread(_call)
+
+async def fetch_core_data(symbol: str):
+    """Gọi đồng thời 3 hàm cache ở trên: khi cache miss, 3 round-trip tới VCI chạy song song."""
+    return await asyncio.gather(
+        to_thread_with_ctx(load_price_history, symbol),
+        to_thread_with_ctx(load_comprehensive, symbol),
+        to_thread_with_ctx(load_index_history, symbol),
+    )
+
+# Tầng bộ nhớ trước tầng đĩa: rerun trúng cache trả ngay, không đọc file và không tạo thread.
+# Exception không được st.cache_data cache nên lỗi tải không bị giữ trong TTL.
+@st.cache_data(ttl=DISK_CACHE_TTL, show_spinner=False)
+def load_core_frames(symbol: str):
+    return run_async(fetch_core_data(symbol))
+
+# Hàm tổng hợp (gọi tầng cache ở trên)
 def load_core_data(symbol: str) -> Dict[str, Any]:
     try:
-        price_history = load_price_history(symbol)
-        comprehensive = load_comprehensive(symbol)
-        index_history = load_index_history(symbol)
+        price_history, comprehensive, index_history = load_core_frames(symbol)
 
         latest_close = comprehensive.get('technical_summary', {}).get('latest_close')
         if latest_close is None:
-            latest_close = float(price_history['close'].iloc[-1]) if not price_history.empty else None
+            close_arr = price_history['close'].to_numpy() if 'close' in price_history else np.empty(0)
+            latest_close = float(close_arr[-1]) if close_arr.size else None
 
         dq = comprehensive.get('data_quality', {})
         dq_score = float(dq.get('completeness_score', 50.0))
@@ -516,12 +710,11 @@ with st.spinner("🔄 Đang tải dữ liệu..."):
     data = load_core_data(symbol)
 
 # Hiển thị thông tin cơ bản
-
-
-info_col1, info_col2= st.columns(2)
 price_history = data.get('price_history', pd.DataFrame())
 total_records = len(price_history)
-last_volume = price_history['volume'].iloc[-1]
+# Đọc phần tử cuối trực tiếp từ mảng numpy (không qua indexing của Series)
+vol_arr = price_history['volume'].to_numpy() if 'volume' in price_history else np.empty(0)
+last_volume = vol_arr[-1] if vol_arr.size else 0
 dq_score = data.get('dq_score', 0)
 latest_price = data.get('latest_close')
 
@@ -551,9 +744,14 @@ if run_btn:
             ai_content = extract_and_parse_ai_json(ai_response)
             
             if ai_content and isinstance(ai_content, dict):
-                # Hiển thị dashboard
-                render_ai_dashboard(ai_content, data['price_history'])
-                
+                # Lưu kết quả để các rerun sau (đổi widget, export) không phải gọi lại AI
+                st.session_state['ai_analysis'] = ai_content
+                st.session_state['symbol'] = symbol
+                st.session_state['analysis_timestamp'] = datetime.now()
+
+# Hiển thị dashboard từ kết quả đã lưu (chỉ khi cùng mã đang chọn)
+if 'ai_analysis' in st.session_state and st.session_state.get('symbol') == symbol:
+    render_dashboard_fragment(st.session_state['ai_analysis'], data.get('price_history'))
                 
 
 
@@ -0,0 +1,33 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+fa = pytest.importorskip("src.agents.fundamental_analyst")
+
+
+def test_compact_numeric_keeps_bank_sized_amounts():
+    # VCB/BID-scale balance sheet, already in tỷ đồng as returned by FundamentalAPI
+    df = pd.DataFrame({
+        "CP": ["BID"],
+        "Năm": [2024],
+        "Kỳ": [4],
+        "TỔNG CỘNG TÀI SẢN (đồng)": [2_760_615.27],
+        "Tiền gửi của khách hàng": [2_006_543.81],
+        "VỐN CHỦ SỞ HỮU (đồng)": [140_210.04],
+    })
+
+    out = fa.compact_numeric(df, 2, relabel_money=True)
+
+    assert out["TỔNG CỘNG TÀI SẢN (tỷ đồng)"].iat[0] == 2_760_615.27
+    assert out["Tiền gửi của khách hàng"].iat[0] == 2_006_543.81
+    assert out["VỐN CHỦ SỞ HỮU (tỷ đồng)"].iat[0] == 140_210.04
+    assert out["Năm"].iat[0] == 2024
+
+
+def test_compact_numeric_rounds_without_relabel():
+    df = pd.DataFrame({"Vòng quay tài sản": [0.123456], "EBIT (Tỷ đồng)": [1234.56789]})
+
+    out = fa.compact_numeric(df)
+
+    assert list(out.columns) == ["Vòng quay tài sản", "EBIT (Tỷ đồng)"]
+    assert out["Vòng quay tài sản"].iat[0] == 0.1235
+    assert out["EBIT (Tỷ đồng)"].iat[0] == 1234.5679